@@ -0,0 +1,108 @@
+"""
+Multithreaded benchmark of DropboxFS.
+
+Runs a mix of getinfo() calls on distinct, uncached paths and full
+downloads with open().read() from a growing number of threads, and
+prints the throughput for every thread count. By default the Dropbox
+API is simulated with fixed latencies, so the numbers show how the
+locking of DropboxFS scales and not how fast the network is. Use
+--coarse to hold the lock of the whole filesystem around every
+operation, which is how DropboxFS behaved with @synchronize.
+
+    python bench_dropboxfs_threads.py
+    python bench_dropboxfs_threads.py --coarse
+    python bench_dropboxfs_threads.py --threads 1,4,16 --ops 400
+
+"""
+import os
+import sys
+import time
+import threading
+import optparse
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from dropbox import client
+from DropboxFS import DropboxFS
+
+# Size of the simulated files that are downloaded (1M).
+FILE_SIZE = 1024**2
+
+
+def simulate_dropbox(metadata_latency, download_latency):
+    """Replaces the calls DropboxFS makes to the Dropbox API by fakes
+    which only sleep."""
+    def metadata(self, path, list=False, **kwargs):
+        time.sleep(metadata_latency)
+        result = {'path': path, 'is_dir': False, 'bytes': FILE_SIZE,
+                  'rev': '1', 'modified': 'Mon, 01 Jan 2024 00:00:00 +0000'}
+        if list:
+            result['is_dir'] = True
+            result['hash'] = '0'
+            result['contents'] = []
+        return result
+    def get_file(self, path, rev=None, start=None, length=None):
+        time.sleep(download_latency)
+        return StringIO('x' * (length or FILE_SIZE))
+    client.DropboxClient.metadata = metadata
+    client.DropboxClient.get_file = get_file
+
+
+def run(fs, threads, ops, download_every, coarse):
+    counter = iter(xrange(ops))
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            if coarse:
+                fs._lock.acquire()
+            try:
+                if i % download_every == 0:
+                    fs.open('/file-%d' % i, lazy=False).read()
+                else:
+                    fs.getinfo('/file-%d' % i)
+            finally:
+                if coarse:
+                    fs._lock.release()
+    workers = [threading.Thread(target=work) for i in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return ops / (time.time() - start)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--threads', default='1,2,4,8,16,32',
+                      help='comma separated thread counts')
+    parser.add_option('--ops', type='int', default=320,
+                      help='operations per run')
+    parser.add_option('--download-every', type='int', default=10,
+                      help='every n-th operation downloads a file')
+    parser.add_option('--metadata-latency', type='float', default=0.05)
+    parser.add_option('--download-latency', type='float', default=0.5)
+    parser.add_option('--coarse', action='store_true',
+                      help='serialize every operation on the FS lock')
+    options, args = parser.parse_args()
+
+    simulate_dropbox(options.metadata_latency, options.download_latency)
+    print "%8s %12s %10s" % ("threads", "ops/s", "speedup")
+    base = None
+    for threads in [int(n) for n in options.threads.split(',')]:
+        fs = DropboxFS(credentials={'access_token': 'benchmark'})
+        rate = run(fs, threads, options.ops, options.download_every,
+                   options.coarse)
+        fs.close()
+        base = base or rate
+        print "%8d %12.1f %9.1fx" % (threads, rate, rate / base)
+
+
+if __name__ == '__main__':
+    main()
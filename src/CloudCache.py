@@ -0,0 +1,773 @@
+"""
+CloudCache
+========
+
+Metadata cache shared by the cloud filesystems.
+
+"""
+import sys
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from UserDict import UserDict
+
+# Items in cache are considered expired after 5 minutes.
+CACHE_TTL = 300
+# Max number of items kept in a cache before the least recently used
+# ones are evicted.
+CACHE_MAX_ENTRIES = 100000
+# Max approximate size of a cache in bytes, None means no limit.
+CACHE_MAX_BYTES = None
+# Paths known not to exist are remembered for 30 seconds.
+NEGATIVE_CACHE_TTL = 30
+# Max number of paths remembered as not existing.
+NEGATIVE_CACHE_MAX_ENTRIES = 10000
+# Max number of items a PersistentCache keeps per account.
+STORE_MAX_ENTRIES = 1000000
+# A PersistentCache checks its size after every this many saved items.
+STORE_TRIM_INTERVAL = 1000
+
+
+def _sizeof(value):
+    #  Approximate size of a value and everything it contains in bytes.
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += _sizeof(key) + _sizeof(item)
+    elif isinstance(value, (list, tuple, set, frozenset, ChildSet)):
+        for item in value:
+            size += _sizeof(item)
+    return size
+
+
+def token_fingerprint(token):
+    """Returns a fingerprint of an access token, safe to use as a key."""
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha1(token or '').hexdigest()
+
+
+class ChildSet(object):
+    """An insertion ordered set of children names (or ids).
+
+    Membership tests, adding and removing a child are O(1). Removed
+    children leave a hole in the order which is compacted once more
+    than half of the slots are holes. Threads may change a set while
+    others read it.
+
+    """
+    __slots__ = ('_order', '_index', '_holes', '_lock')
+
+    _HOLE = object()
+
+    def __init__(self, children=()):
+        self._order = []
+        self._index = {}
+        self._holes = 0
+        self._lock = threading.Lock()
+        for name in children:
+            self.add(name)
+
+    def add(self, name):
+        with self._lock:
+            if name not in self._index:
+                self._index[name] = len(self._order)
+                self._order.append(name)
+
+    def discard(self, name):
+        with self._lock:
+            i = self._index.pop(name, None)
+            if i is None:
+                return
+            if i >= len(self._order) or self._order[i] != name:
+                # The slot doesn't hold name, rebuild the index
+                self._order = [child for child in self._order
+                               if child != name]
+                self._compact()
+                return
+            self._order[i] = self._HOLE
+            self._holes += 1
+            if self._holes * 2 > len(self._order):
+                self._compact()
+
+    def _compact(self):
+        self._order = [name for name in self._order if name is not self._HOLE]
+        self._index = dict((name, i) for i, name in enumerate(self._order))
+        self._holes = 0
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        hole = self._HOLE
+        for name in self._order:
+            if name is not hole:
+                yield name
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return "ChildSet(%r)" % list(self)
+
+
+class CacheItem(object):
+    """Represents a path in the cache.
+
+    There are two components to a path. It's individual metadata,
+    and the children contained within it. If only some fields of the
+    metadata were fetched, fields lists them (comma separated).
+
+    """
+    __slots__ = ('metadata', 'children', 'parents', 'timestamp', 'fields')
+
+    def __init__(self, metadata=None, children=None, timestamp=None,
+                 parents=None, fields=None):
+        self.metadata = metadata
+        self.fields = fields
+        if children is not None and not isinstance(children, ChildSet):
+            children = ChildSet(children)
+        self.children = children
+        self.parents = parents
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
+    def add_child(self, name, client=None):
+        if self.children is None:
+            if client != None:
+                # When you add a child to a folder that was still not
+                # listed, that folder gets only one child when you list
+                # it afterwards. So the folder is listed first.
+                client.children(self.metadata['id'])
+            else:
+                self.children = ChildSet([name])
+        else:
+            self.children.add(name)
+
+    def del_child(self, name):
+        if self.children is not None:
+            self.children.discard(name)
+
+    def _get_expired(self):
+        if self.timestamp <= time.time() - CACHE_TTL:
+            return True
+    expired = property(_get_expired)
+
+    def renew(self):
+        self.timestamp = time.time()
+
+    def covers(self, fields):
+        """Checks if the cached metadata contains the given fields
+        (None means all fields)."""
+        if self.fields is None:
+            return True
+        if fields is None:
+            return False
+        return set(fields.split(',')) <= set(self.fields.split(','))
+
+
+class CloudCache(UserDict):
+    """A bounded cache of CacheItems.
+
+    Items are kept in least recently used order. When the cache holds
+    more than max_entries items, or more than max_bytes (approximately)
+    of metadata, the least recently used items are evicted. Expired
+    items are removed by sweep(), which can also run periodically in a
+    background thread.
+
+    Eviction only forgets an item, it never touches the children lists
+    of its parents, so an evicted path is simply fetched again on the
+    next lookup.
+
+    @param max_entries: max number of items, None means no limit
+    @param max_bytes: max approximate size of all items, None means
+        no limit
+    @param sweep_interval: if set, expired items are removed every
+        sweep_interval seconds by a daemon thread
+    @param store: optional PersistentCache. Items missing in memory are
+        looked up in it, and every change is written through to it.
+    @param missing_ttl: seconds for which keys that don't exist are
+        remembered in missing
+
+    The clients add keys they found not to exist to missing, a
+    NegativeCache. Storing an item under a key removes the key from it.
+
+    The clients of services which address files by id keep the names
+    of the files they've seen in paths, a PathIndex.
+
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES,
+                 max_bytes=CACHE_MAX_BYTES, sweep_interval=None, store=None,
+                 missing_ttl=NEGATIVE_CACHE_TTL):
+        UserDict.__init__(self)
+        self.data = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store = store
+        self.missing = NegativeCache(missing_ttl)
+        # Names of the children of folders -> ids, see PathIndex. It's
+        # enabled by the filesystems which resolve paths of names.
+        self.paths = PathIndex(max_entries=max_entries, enabled=False)
+        # While False, items never expire. This is for caches which are
+        # kept up to date by a change feed of the cloud service.
+        self.expire = True
+        # Items cached before this time are stale, see invalidate()
+        self._valid_after = 0
+        self._lock = threading.RLock()
+        self._sizes = {}
+        self._bytes = 0
+        self._sweeper = None
+        if sweep_interval:
+            self.start_sweeper(sweep_interval)
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key not in self.data:
+                #  An item bigger than max_bytes is evicted as soon as
+                #  it's loaded, so it's returned from here.
+                item = self._load(key)
+                if item is None:
+                    raise KeyError(key)
+                return item
+            item = self.data.pop(key)
+            self.data[key] = item
+            return item
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.data or self._load(key) is not None
+
+    has_key = __contains__
+
+    def __setitem__(self, key, item):
+        with self._lock:
+            self.missing.discard(key)
+            self._insert(key, item)
+            if self.store is not None:
+                self.store.save(key, item)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self.store is not None:
+                self.store.delete(key)
+            self._forget(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *args):
+        with self._lock:
+            if key not in self.data:
+                self._load(key)
+            if self.store is not None:
+                self.store.delete(key)
+            if key not in self.data:
+                if args:
+                    return args[0]
+                raise KeyError(key)
+            return self._forget(key)
+
+    def configure(self, max_entries=CACHE_MAX_ENTRIES,
+                  max_bytes=CACHE_MAX_BYTES, sweep_interval=None):
+        """Sets the limits of a cache which was created by a client, and
+        starts the sweeper if sweep_interval is set."""
+        with self._lock:
+            if max_bytes is not None and self.max_bytes is None:
+                for key, item in self.data.iteritems():
+                    self._sizes[key] = size = self._sizeof(item)
+                    self._bytes += size
+            elif max_bytes is None:
+                self._sizes.clear()
+                self._bytes = 0
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+            self.paths.max_entries = max_entries
+            self.paths.trim()
+        if sweep_interval:
+            self.start_sweeper(sweep_interval)
+
+    def persist(self, key):
+        """Writes the metadata of an item that was changed in place
+        through to the store."""
+        with self._lock:
+            if self.store is not None and key in self.data:
+                self.store.save(key, self.data[key], children=False)
+
+    def persist_children(self, key, added=(), removed=()):
+        """Writes children that were added to or removed from an item
+        in place through to the store."""
+        with self._lock:
+            if self.store is None:
+                return
+            if (not self.store.save_children(key, added, removed) and
+                    key in self.data):
+                self.store.save(key, self.data[key])
+
+    def clear(self):
+        with self._lock:
+            if self.store is not None:
+                self.store.clear()
+            self.missing.clear()
+            self.paths.clear()
+            self.data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def invalidate(self):
+        """Marks everything cached so far, in memory and in the store, as
+        stale. Unlike clear(), nothing is dropped: items are revalidated
+        on their next use, and keep what's needed for that (e.g. hashes
+        of listings). The path index, which lives only in memory, is
+        dropped."""
+        with self._lock:
+            self.missing.clear()
+            self.paths.clear()
+            self._valid_after = time.time()
+
+    def stale(self, item):
+        """Checks if an item has to be fetched (or revalidated) again."""
+        if item.timestamp <= self._valid_after:
+            return True
+        return self.expire and bool(item.expired)
+
+    def sweep(self):
+        """Removes all expired items from the cache."""
+        if not self.expire:
+            return
+        with self._lock:
+            for key, item in self.data.items():
+                if item.expired:
+                    self._forget(key)
+
+    def start_sweeper(self, interval):
+        """Starts a daemon thread which calls sweep() every interval
+        seconds, as long as the cache exists."""
+        if self._sweeper is not None:
+            return
+        stop = threading.Event()
+        ref = weakref.ref(self)
+        def run():
+            while not stop.wait(interval):
+                cache = ref()
+                if cache is None:
+                    return
+                cache.sweep()
+                del cache
+        self._sweeper = stop
+        thread = threading.Thread(target=run, name="CloudCache sweeper")
+        thread.daemon = True
+        thread.start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.set()
+            self._sweeper = None
+
+    def _insert(self, key, item):
+        if key in self.data:
+            self._forget(key)
+        self.data[key] = item
+        if self.max_bytes is not None:
+            self._sizes[key] = size = self._sizeof(item)
+            self._bytes += size
+        self._evict()
+
+    def _load(self, key):
+        #  Brings an item from the store into memory, without writing
+        #  it back.
+        if self.store is None:
+            return None
+        item = self.store.load(key)
+        if item is not None:
+            self._insert(key, item)
+        return item
+
+    def _forget(self, key):
+        #  Removes key without touching the parents of the item.
+        item = self.data.pop(key)
+        self._bytes -= self._sizes.pop(key, 0)
+        return item
+
+    def _evict(self):
+        #  Drops least recently used items until the cache fits its limits.
+        while self.data and (
+                (self.max_entries is not None and
+                 len(self.data) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self._bytes > self.max_bytes)):
+            self._forget(next(iter(self.data)))
+
+    def _sizeof(self, item):
+        return (_sizeof(getattr(item, 'metadata', None)) +
+                _sizeof(getattr(item, 'children', None)))
+
+
+class NegativeCache(object):
+    """Remembers paths (or ids) which were looked up and don't exist.
+
+    A lookup of such a path can fail right away instead of asking the
+    cloud service again. Entries expire after ttl seconds, and when
+    more than max_entries are kept the oldest ones are dropped. Whoever
+    creates something at a path has to discard() it.
+
+    @param ttl: seconds a path is remembered
+    @param max_entries: max number of paths kept
+    @param normalize: optional function applied to every key, e.g. to
+        make paths case insensitive
+
+    """
+    def __init__(self, ttl=NEGATIVE_CACHE_TTL,
+                 max_entries=NEGATIVE_CACHE_MAX_ENTRIES, normalize=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.normalize = normalize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        if self.normalize is not None:
+            key = self.normalize(key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        if self.normalize is not None:
+            key = self.normalize(key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_tree(self, path):
+        "Discard path and every path below it."
+        if self.normalize is not None:
+            path = self.normalize(path)
+        path = path.rstrip('/')
+        prefix = path + '/'
+        with self._lock:
+            for key in self._entries.keys():
+                if key == path or (isinstance(key, basestring) and
+                                   key.startswith(prefix)):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        if self.normalize is not None:
+            key = self.normalize(key)
+        with self._lock:
+            timestamp = self._entries.get(key)
+            if timestamp is None:
+                return False
+            if timestamp <= time.time() - self.ttl:
+                del self._entries[key]
+                return False
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PathIndex(object):
+    """Maps the names of the children of folders to their ids, so a path
+    of names can be resolved to an id without asking for every folder.
+
+    The index is filled incrementally, from listings of folders and from
+    lookups of single names. A folder can have many children with the
+    same name, lookup() then always returns the one with the smallest
+    sort key (e.g. creation time), so a path resolves the same way every
+    time. A folder whose whole listing was indexed is complete: a name
+    it doesn't have doesn't exist.
+
+    Entries and complete listings older than the ttl given to lookup()
+    and is_complete() are ignored, None accepts any age. Whoever
+    renames, moves or deletes a child has to discard() it. When more
+    than max_entries children are indexed, the folders used least
+    recently are forgotten. While enabled is False nothing is indexed.
+
+    @param normalize: optional function applied to every name, e.g. to
+        make names case insensitive
+    @param max_entries: max number of indexed children, None means no
+        limit
+    @param enabled: whether children are indexed at all
+
+    """
+    def __init__(self, normalize=None, max_entries=CACHE_MAX_ENTRIES,
+                 enabled=True):
+        self.normalize = normalize
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # folder id -> {name: {child id: (sort key, time indexed)}}, in
+        # least recently used order
+        self._folders = OrderedDict()
+        # child id -> set of (folder id, name)
+        self._names = {}
+        # folder id -> time of its complete listing
+        self._complete = {}
+        self._lock = threading.RLock()
+
+    def lookup(self, parent_id, name, ttl=None):
+        """Returns the id of the child of parent_id called name, or None
+        if it isn't known."""
+        deadline = time.time() - ttl if ttl is not None else None
+        if self.normalize is not None:
+            name = self.normalize(name)
+        with self._lock:
+            names = self._folders.pop(parent_id, None)
+            if names is None:
+                return None
+            self._folders[parent_id] = names
+            candidates = names.get(name, {})
+            found = [(sort_key, child_id) for child_id, (sort_key, timestamp)
+                     in candidates.iteritems()
+                     if deadline is None or timestamp > deadline]
+        return min(found)[1] if found else None
+
+    def is_complete(self, parent_id, ttl=None):
+        """Checks if all children of parent_id are indexed."""
+        timestamp = self._complete.get(parent_id)
+        if timestamp is None:
+            return False
+        return ttl is None or timestamp > time.time() - ttl
+
+    def add(self, parent_id, name, child_id, sort_key=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._add(parent_id, name, child_id, sort_key)
+            self.trim()
+
+    def set_children(self, parent_id, entries):
+        """Replaces the children of parent_id with its whole listing and
+        marks it complete.
+
+        @param entries: (name, child id, sort key) triples
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.forget(parent_id)
+            for name, child_id, sort_key in entries:
+                self._add(parent_id, name, child_id, sort_key)
+            self._complete[parent_id] = time.time()
+            self.trim()
+
+    def discard(self, child_id):
+        """Removes a child from all folders it is indexed in."""
+        with self._lock:
+            for parent_id, name in self._names.pop(child_id, ()):
+                names = self._folders.get(parent_id, {})
+                candidates = names.get(name)
+                if candidates is not None:
+                    candidates.pop(child_id, None)
+                    if not candidates:
+                        del names[name]
+
+    def forget(self, parent_id):
+        """Forgets the children of a folder (e.g. when it's deleted)."""
+        with self._lock:
+            self._complete.pop(parent_id, None)
+            for name, candidates in self._folders.pop(parent_id,
+                                                      {}).iteritems():
+                for child_id in candidates:
+                    links = self._names.get(child_id)
+                    if links is not None:
+                        links.discard((parent_id, name))
+                        if not links:
+                            del self._names[child_id]
+
+    def clear(self):
+        with self._lock:
+            self._folders.clear()
+            self._names.clear()
+            self._complete.clear()
+
+    def trim(self):
+        """Forgets the folders used least recently until at most
+        max_entries children are indexed. The folder used last is kept."""
+        with self._lock:
+            while (self.max_entries is not None and
+                   len(self._names) > self.max_entries and
+                   len(self._folders) > 1):
+                self.forget(next(iter(self._folders)))
+
+    def _add(self, parent_id, name, child_id, sort_key):
+        if self.normalize is not None:
+            name = self.normalize(name)
+        names = self._folders.pop(parent_id, None)
+        if names is None:
+            names = {}
+        self._folders[parent_id] = names
+        names.setdefault(name, {})[child_id] = (sort_key, time.time())
+        self._names.setdefault(child_id, set()).add((parent_id, name))
+
+    def __len__(self):
+        return len(self._names)
+
+
+class PersistentCache(object):
+    """Keeps cache items in an SQLite database, so they survive process
+    restarts.
+
+    Items are keyed by account and path (or id) and stored together with
+    their original timestamp, so CACHE_TTL expiry and revalidation work
+    the same way as for items that never left memory. Every child of a
+    folder is a row of its own, so adding or removing one child doesn't
+    rewrite the whole listing. When an account has more than max_entries
+    items, the ones fetched longest ago are deleted. Several processes
+    can share one database file.
+
+    @param filename: path to the SQLite database
+    @param account: identifies the account the items belong to
+    @param max_entries: max number of items kept for the account
+
+    """
+    def __init__(self, filename, account, max_entries=STORE_MAX_ENTRIES):
+        self.account = account
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._saves = 0
+        self._db = sqlite3.connect(filename, timeout=30,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                         "account TEXT, key TEXT, metadata TEXT, "
+                         "listed INTEGER, parents TEXT, timestamp REAL, "
+                         "fields TEXT, "
+                         "PRIMARY KEY (account, key))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_entries_age "
+                         "ON cache_entries (account, timestamp)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache_children ("
+                         "account TEXT, key TEXT, child TEXT, "
+                         "PRIMARY KEY (account, key, child))")
+
+    def load(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT metadata, listed, parents, "
+                                   "timestamp, fields FROM cache_entries "
+                                   "WHERE account = ? AND key = ?",
+                                   (self.account, key)).fetchone()
+            if row is None:
+                return None
+            children = None
+            if row[1]:
+                # Children are returned in the order they were added
+                children = [child for (child,) in self._db.execute(
+                    "SELECT child FROM cache_children "
+                    "WHERE account = ? AND key = ? ORDER BY rowid",
+                    (self.account, key))]
+        metadata, parents = [json.loads(value) for value in
+                             (row[0], row[2])]
+        return CacheItem(metadata, children, row[3], parents, row[4])
+
+    def save(self, key, item, children=True):
+        """Stores an item. With children=False only its metadata,
+        parents and timestamp are written, unless it isn't stored yet."""
+        row = (json.dumps(item.metadata), item.children is not None,
+               json.dumps(item.parents), item.timestamp, item.fields)
+        with self._transaction() as db:
+            if not children:
+                cursor = db.execute("UPDATE cache_entries SET metadata = ?, "
+                                    "listed = ?, parents = ?, timestamp = ?, "
+                                    "fields = ? "
+                                    "WHERE account = ? AND key = ?",
+                                    row + (self.account, key))
+                if cursor.rowcount:
+                    return
+            db.execute("INSERT OR REPLACE INTO cache_entries VALUES "
+                       "(?, ?, ?, ?, ?, ?, ?)", (self.account, key) + row)
+            db.execute("DELETE FROM cache_children "
+                       "WHERE account = ? AND key = ?", (self.account, key))
+            if item.children is not None:
+                db.executemany("INSERT OR IGNORE INTO cache_children "
+                               "VALUES (?, ?, ?)",
+                               [(self.account, key, child)
+                                for child in item.children])
+            self._saves += 1
+            if self._saves % STORE_TRIM_INTERVAL == 0:
+                self._trim(db)
+
+    def save_children(self, key, added=(), removed=()):
+        """Adds and removes children of a stored item.
+
+        @return: False if the item isn't stored, then nothing is written
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE cache_entries "
+                                "SET listed = listed OR ? "
+                                "WHERE account = ? AND key = ?",
+                                (bool(added), self.account, key))
+            if not cursor.rowcount:
+                return False
+            db.executemany("DELETE FROM cache_children "
+                           "WHERE account = ? AND key = ? AND child = ?",
+                           [(self.account, key, child) for child in removed])
+            db.executemany("INSERT OR IGNORE INTO cache_children "
+                           "VALUES (?, ?, ?)",
+                           [(self.account, key, child) for child in added])
+        return True
+
+    def keys(self):
+        with self._lock:
+            rows = self._db.execute("SELECT key FROM cache_entries "
+                                    "WHERE account = ?",
+                                    (self.account,)).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, key):
+        with self._transaction() as db:
+            for table in ("cache_entries", "cache_children"):
+                db.execute("DELETE FROM %s WHERE account = ? AND key = ?"
+                           % table, (self.account, key))
+
+    def clear(self):
+        with self._transaction() as db:
+            for table in ("cache_entries", "cache_children"):
+                db.execute("DELETE FROM %s WHERE account = ?" % table,
+                           (self.account,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @contextmanager
+    def _transaction(self):
+        #  Runs the statements of the block atomically.
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield self._db
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _trim(self, db):
+        #  Deletes the items fetched longest ago, until the account has
+        #  at most max_entries of them.
+        count = db.execute("SELECT COUNT(*) FROM cache_entries "
+                           "WHERE account = ?", (self.account,)).fetchone()[0]
+        if self.max_entries is None or count <= self.max_entries:
+            return
+        keys = [(self.account, key) for (key,) in db.execute(
+            "SELECT key FROM cache_entries WHERE account = ? "
+            "ORDER BY timestamp LIMIT ?",
+            (self.account, count - self.max_entries)).fetchall()]
+        for table in ("cache_entries", "cache_children"):
+            db.executemany("DELETE FROM %s WHERE account = ? AND key = ?"
+                           % table, keys)
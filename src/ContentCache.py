@@ -0,0 +1,199 @@
+"""
+ContentCache
+========
+
+Local on-disk cache of downloaded file bodies, shared by the cloud
+filesystems.
+
+"""
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from StringIO import StringIO
+
+# Max size of all cached file bodies together (1G).
+CONTENT_CACHE_MAX_BYTES = 1024**3
+# Size of the chunks in which bodies are copied into the cache (64K).
+CHUNK_SIZE = 1024*64
+
+
+def _digest(*parts):
+    md5 = hashlib.md5()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        md5.update(str(part))
+        md5.update('\0')
+    return md5.hexdigest()
+
+
+class ContentCache(object):
+    """Keeps downloaded file bodies in a local directory.
+
+    A body is stored under (account, key, revision), where key is the
+    id or path of the file and revision is whatever the cloud service
+    changes when the contents change (md5Checksum/etag on Google Drive,
+    rev on Dropbox, updated_time on SkyDrive). A lookup with a revision
+    that doesn't match the stored one is a miss, so stale bodies are
+    never served. Storing a new revision drops the older ones.
+
+    When the cache grows over max_bytes, the least recently used bodies
+    are deleted. Bodies bigger than max_bytes aren't cached at all. One
+    cache can be shared by many filesystems and accounts.
+
+    @param directory: directory where the bodies are kept
+    @param max_bytes: max size of all bodies together
+
+    """
+    def __init__(self, directory, max_bytes=CONTENT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Size of all cached bodies, counted when it's first needed
+        self._bytes = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, account, key, revision):
+        """Returns the cached body as a file opened for reading, or None
+        if the body of this revision isn't cached."""
+        if not revision:
+            return None
+        filename = self._filename(account, key, revision)
+        try:
+            f = open(filename, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        # The modification time tells which bodies were used last.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return f
+
+    def store(self, account, key, revision, data):
+        """Stores a body and returns it as a file opened for reading.
+
+        A body bigger than max_bytes is returned without being cached.
+
+        @param data: a string or a file like object with a read method,
+            which is copied chunk by chunk
+        """
+        if isinstance(data, basestring) and len(data) > self.max_bytes:
+            return StringIO(data)
+        filename = self._filename(account, key, revision)
+        dirname = os.path.dirname(filename)
+        with self._lock:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(data, basestring):
+                    f.write(data)
+                    size = len(data)
+                else:
+                    while True:
+                        chunk = data.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        size += len(chunk)
+            if size > self.max_bytes:
+                # It doesn't fit, hand it out from a temporary file which
+                # is deleted when it's closed.
+                body = tempfile.TemporaryFile()
+                with open(tmpname, 'rb') as f:
+                    shutil.copyfileobj(f, body, CHUNK_SIZE)
+                os.remove(tmpname)
+                body.seek(0)
+                return body
+            with self._lock:
+                replaced = self._size(filename)
+                os.rename(tmpname, filename)
+                if self._bytes is not None:
+                    self._bytes += size - replaced
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        self.discard(account, key, keep=filename)
+        self.trim(keep=filename)
+        return open(filename, 'rb')
+
+    def discard(self, account, key, keep=None):
+        """Removes all cached revisions of a file (except keep)."""
+        dirname = os.path.join(self.directory, _digest(account, key))
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return
+        for name in names:
+            filename = os.path.join(dirname, name)
+            if filename != keep and not name.endswith('.tmp'):
+                with self._lock:
+                    size = self._size(filename)
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        continue
+                    if self._bytes is not None:
+                        self._bytes -= size
+
+    def trim(self, keep=None):
+        """Deletes the least recently used bodies (except keep) until the
+        cache fits into max_bytes."""
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for mtime, size, filename
+                                  in self._blobs())
+            if self._bytes <= self.max_bytes:
+                return
+            # Only a cache which is over the limit is walked, to find the
+            # least recently used bodies.
+            blobs = self._blobs()
+            total = self._bytes = sum(size for mtime, size, filename
+                                      in blobs)
+            blobs.sort()
+            for mtime, size, filename in blobs:
+                if total <= self.max_bytes:
+                    break
+                if filename == keep:
+                    continue
+                try:
+                    os.remove(filename)
+                    total -= size
+                except OSError:
+                    pass
+            self._bytes = total
+
+    def _blobs(self):
+        #  (modification time, size, filename) of all cached bodies.
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, filename))
+        return blobs
+
+    def _size(self, filename):
+        try:
+            return os.stat(filename).st_size
+        except OSError:
+            return 0
+
+    def _filename(self, account, key, revision):
+        return os.path.join(self.directory, _digest(account, key),
+                            _digest(revision))
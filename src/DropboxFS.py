@@ -7,78 +7,109 @@ A FS object that integrates with Dropbox.
 """
 import os
 import time
+import socket
+import bisect
+import threading
 import datetime
 import calendar
-from UserDict import UserDict
+from StringIO import StringIO
 from fs.base import *
 from fs.path import *
 from fs.errors import DirectoryNotEmptyError, UnsupportedError, \
                       CreateFailedError, ResourceInvalidError, \
                       ResourceNotFoundError, \
-                      OperationFailedError, DestinationExistsError
-from fs.remote import RemoteFileBuffer
+                      OperationFailedError, DestinationExistsError, \
+                      RemoteConnectionError
 from fs.filelike import SpooledTemporaryFile
+from CloudCache import CloudCache, CacheItem, PersistentCache, \
+                       token_fingerprint, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES
+from RemoteFile import RemoteRangeFile, CloudFileBuffer, readonly_mode
+from SingleFlight import SingleFlight
+from StripedLock import StripedLock
+from TokenValidation import UnauthorizedError, validations
 
 from dropbox import rest
 from dropbox import client
 
-# Items in cache are considered expired after 5 minutes.
-CACHE_TTL = 300
 # The format Dropbox uses for times.
 TIME_FORMAT = '%a, %d %b %Y %H:%M:%S +0000'
 # Max size for spooling to memory before using disk (5M).
 MAX_BUFFER = 1024**2*5
+# Size of the chunks in which downloads are copied to the spooled file (64K).
+CHUNK_SIZE = 1024*64
+# Files bigger than this are uploaded in chunks with an upload session (8M).
+CHUNKED_UPLOAD_THRESHOLD = 1024**2*8
+# Size of one chunk of a chunked upload (4M).
+UPLOAD_CHUNK_SIZE = 1024**2*4
+# How many times a failed upload chunk is retried before giving up.
+UPLOAD_RETRIES = 5
 
 
-class CacheItem(object):
-    """Represents a path in the cache. There are two components to a path.
-       It's individual metadata, and the children contained within it."""
-    def __init__(self, metadata=None, children=None, timestamp=None):
-        self.metadata = metadata
-        self.children = children
-        if timestamp is None:
-            timestamp = time.time()
-        self.timestamp = timestamp
-
-    def add_child(self, name):
-        if self.children is None:
-            self.children = [name]
-        else:
-            self.children.append(name)
-
-    def del_child(self, name):
-        if self.children is None:
-            return
-        try:
-            i = self.children.index(name)
-        except ValueError:
-            return
-        self.children.pop(i)
-
-    def _get_expired(self):
-        if self.timestamp <= time.time() - CACHE_TTL:
-            return True
-    expired = property(_get_expired)
-
-    def renew(self):
-        self.timestamp = time.time()
+class DropboxCache(CloudCache):
+    def __init__(self, **kwargs):
+        CloudCache.__init__(self, **kwargs)
+        # Dropbox paths are case insensitive.
+        self.missing.normalize = lambda path: path.lower()
 
+    # The item and the children of its parent are changed under the
+    # cache lock, so no thread sees one change without the other.
 
-class DropboxCache(UserDict):
     def set(self, path, metadata):
-        self[path] = CacheItem(metadata)
-        dname, bname = pathsplit(path)
-        item = self.get(dname)
-        if item:
-            item.add_child(bname)
+        with self._lock:
+            self[path] = CacheItem(metadata)
+            dname, bname = pathsplit(path)
+            item = self.get(dname)
+            if item:
+                item.add_child(bname)
+                self.persist_children(dname, added=[bname])
 
     def pop(self, path, default=None):
-        value = UserDict.pop(self, path, default)
-        dname, bname = pathsplit(path)
-        item = self.get(dname)
-        if item:
-            item.del_child(bname)
-        return value
+        with self._lock:
+            value = CloudCache.pop(self, path, default)
+            dname, bname = pathsplit(path)
+            item = self.get(dname)
+            if item:
+                item.del_child(bname)
+                self.persist_children(dname, removed=[bname])
+            return value
+
+
+class ValidatingRESTClient(object):
+    """Passes requests on to a REST client and reports to validations
+         whether the access token was accepted. A 401 response raises
+         UnauthorizedError."""
+    def __init__(self, rest_client, client):
+        self.rest_client = rest_client
+        self.client = client
+
+    def request(self, *args, **kwargs):
+        return self._call('request', args, kwargs)
+
+    def GET(self, *args, **kwargs):
+        return self._call('GET', args, kwargs)
+
+    def POST(self, *args, **kwargs):
+        return self._call('POST', args, kwargs)
+
+    def PUT(self, *args, **kwargs):
+        return self._call('PUT', args, kwargs)
+
+    def _call(self, name, args, kwargs):
+        account = self.client.account
+        validations = self.client.validations
+        try:
+            result = getattr(self.rest_client, name)(*args, **kwargs)
+        except rest.ErrorResponse, e:
+            if e.status == 401:
+                if account is not None:
+                    validations.failed(account)
+                raise UnauthorizedError(msg=str(e))
+            if account is not None:
+                validations.succeeded(account)
+            raise
+        if account is not None:
+            validations.succeeded(account)
+        return result
 
 
 class DropboxClient(client.DropboxClient):
@@ -86,7 +117,15 @@ class DropboxClient(client.DropboxClient):
          caching as well as converting errors to fs exceptions."""
     def __init__(self, *args, **kwargs):
         super(DropboxClient, self).__init__(*args, **kwargs)
+        # Fingerprint of the access token, set by DropboxFS.
+        self.account = None
+        # ValidationCache the outcomes of the requests are reported to.
+        self.validations = validations
+        self.rest_client = ValidatingRESTClient(self.rest_client, self)
         self.cache = DropboxCache()
+        # Cursor of the last /delta call, see sync_delta().
+        self.delta_cursor = None
+        self._flight = SingleFlight()
 
     # Below we split the DropboxClient metadata() method into two methods
     # metadata() and children(). This allows for more fine-grained fetches
@@ -95,30 +134,45 @@ class DropboxClient(client.DropboxClient):
     def metadata(self, path):
         "Gets metadata for a given path."
         item = self.cache.get(path)
-        if not item or item.metadata is None or item.expired:
-            try:
-                metadata = super(DropboxClient, self).metadata(path,
-                    include_deleted=False, list=False)
-            except rest.ErrorResponse, e:
-                if e.status == 404:
-                    raise ResourceNotFoundError(path)
-                raise OperationFailedError(opname='metadata', path=path,
-                                            msg=str(e) )
-            if metadata.get('is_deleted', False):
+        if not item or item.metadata is None or self.cache.stale(item):
+            if path in self.cache.missing:
                 raise ResourceNotFoundError(path)
-            item = self.cache[path] = CacheItem(metadata)
+            # Concurrent lookups of the same path share one request.
+            item = self._flight.do(('metadata', path),
+                                   self._fetch_metadata, path)
         # Copy the info so the caller cannot affect our cache.
         return dict(item.metadata.items())
 
+    def _fetch_metadata(self, path):
+        #  Fetches metadata of path into the cache and returns the item.
+        item = self.cache.get(path)
+        if item and item.metadata is not None and not self.cache.stale(item):
+            # Another thread has just fetched it.
+            return item
+        try:
+            metadata = super(DropboxClient, self).metadata(path,
+                include_deleted=False, list=False)
+        except rest.ErrorResponse, e:
+            if e.status == 404:
+                self.cache.missing.add(path)
+                raise ResourceNotFoundError(path)
+            raise OperationFailedError(opname='metadata', path=path,
+                                        msg=str(e) )
+        if metadata.get('is_deleted', False):
+            self.cache.missing.add(path)
+            raise ResourceNotFoundError(path)
+        item = self.cache[path] = CacheItem(metadata)
+        return item
+
     def children(self, path):
         "Gets children of a given path."
         update, hash = False, None
         item = self.cache.get(path)
         if item:
-            if item.expired:
+            if self.cache.stale(item):
                 update = True
                 if item.metadata and item.children:
-                    hash = item.metadata['hash']
+                    hash = item.metadata.get('hash')
             else:
                 if not item.metadata.get('is_dir'):
                     raise ResourceInvalidError(path)
@@ -127,26 +181,126 @@ class DropboxClient(client.DropboxClient):
         else:
             update = True
         if update:
-            try:
-                metadata = super(DropboxClient, self).metadata(path, hash=hash,
-                    include_deleted=False, list=True)
-                children = []
-                contents = metadata.pop('contents')
-                for child in contents:
-                    if child.get('is_deleted', False):
+            item = self._flight.do(('children', path), self._fetch_children,
+                                   path, item, hash)
+        return list(item.children)
+
+    def _fetch_children(self, path, item, hash):
+        #  Lists path into the cache and returns its item.
+        try:
+            metadata = super(DropboxClient, self).metadata(path, hash=hash,
+                include_deleted=False, list=True)
+            children = []
+            contents = metadata.pop('contents')
+            for child in contents:
+                if child.get('is_deleted', False):
+                    continue
+                children.append(basename(child['path']))
+                self.cache[child['path']] = CacheItem(child)
+            item = self.cache[path] = CacheItem(metadata, children)
+        except rest.ErrorResponse, e:
+            if not item or e.status != 304:
+                raise OperationFailedError(opname='metadata', path=path,
+                                            msg=str(e) )
+            # We have an item from cache (perhaps expired), but it's
+            # hash is still valid (as far as Dropbox is concerned),
+            # so just renew it and keep using it.
+            item.renew()
+        return item
+
+    def sync_delta(self):
+        """Fetches the changes made since the last call from /delta and
+           applies them to the cache. The first call only remembers the
+           latest cursor and invalidates everything cached before it."""
+        try:
+            if self.delta_cursor is None:
+                result = super(DropboxClient, self).delta_latest_cursor()
+                self.cache.invalidate()
+                self.delta_cursor = result['cursor']
+                return
+            has_more = True
+            while has_more:
+                result = super(DropboxClient, self).delta(self.delta_cursor)
+                if result['reset']:
+                    self.cache.invalidate()
+                self._apply_delta_entries(result['entries'])
+                self.delta_cursor = result['cursor']
+                has_more = result['has_more']
+        except rest.ErrorResponse, e:
+            raise OperationFailedError(opname='delta', msg=str(e) )
+
+    def wait_for_delta(self, timeout=30):
+        """Blocks until there are changes after the current cursor, or
+           timeout seconds pass. Returns the longpoll result with the
+           'changes' and optional 'backoff' keys."""
+        try:
+            return super(DropboxClient, self).longpoll_delta(
+                self.delta_cursor, timeout=timeout)
+        except rest.ErrorResponse, e:
+            raise OperationFailedError(opname='longpoll_delta', msg=str(e) )
+
+    def _apply_delta_entries(self, entries):
+        #  Dropbox reports lowercased paths, but the cache is keyed by the
+        #  paths callers used, so the cache keys are matched case
+        #  insensitively. Items which were evicted from memory still live
+        #  in the store, so its keys are matched as well.
+        keys = set(self.cache.keys())
+        if self.cache.store is not None:
+            keys.update(self.cache.store.keys())
+        lowered = {}
+        for key in keys:
+            lowered.setdefault(key.lower(), []).append(key)
+        ordered = sorted(lowered)
+        for lower_path, metadata in entries:
+            # Whatever the feed reports about a path replaces what we
+            # knew, including that it didn't exist.
+            self.cache.missing.discard(lower_path)
+            if metadata is None:
+                # The path and everything below it was deleted.
+                prefix = lower_path.rstrip('/') + '/'
+                lowers = [lower_path]
+                i = bisect.bisect_left(ordered, prefix)
+                while i < len(ordered) and ordered[i].startswith(prefix):
+                    lowers.append(ordered[i])
+                    i += 1
+                for lower in lowers:
+                    for key in lowered.pop(lower, ()):
+                        self.cache.pop(key, None)
+                # The parent may be cached under a differently cased
+                # path, and lists the child under its original case.
+                name = basename(lower_path)
+                for parent in lowered.get(dirname(lower_path), ()):
+                    item = self.cache.get(parent)
+                    if item is None or item.children is None:
                         continue
-                    children.append(basename(child['path']))
-                    self.cache[child['path']] = CacheItem(child)
-                item = self.cache[path] = CacheItem(metadata, children)
-            except rest.ErrorResponse, e:
-                if not item or e.status != 304:
-                    raise OperationFailedError(opname='metadata', path=path,
-                                                msg=str(e) )
-                # We have an item from cache (perhaps expired), but it's
-                # hash is still valid (as far as Dropbox is concerned),
-                # so just renew it and keep using it.
-                item.renew()
-        return item.children
+                    removed = [child for child in item.children
+                               if child.lower() == name]
+                    for child in removed:
+                        item.del_child(child)
+                    self.cache.persist_children(parent, removed=removed)
+            elif lower_path in lowered:
+                for key in lowered[lower_path]:
+                    item = self.cache.get(key)
+                    if item is not None:
+                        # Delta entries have no hash, the one of the last
+                        # listing still revalidates the children.
+                        if (item.metadata and 'hash' in item.metadata and
+                                'hash' not in metadata):
+                            metadata = dict(metadata, hash=item.metadata['hash'])
+                        item.metadata = metadata
+                        item.renew()
+                        self.cache.persist(key)
+            else:
+                key = metadata['path']
+                self.cache[key] = CacheItem(metadata)
+                lowered[lower_path] = [key]
+                bisect.insort(ordered, lower_path)
+                for parent in lowered.get(dirname(lower_path), ()):
+                    item = self.cache.get(parent)
+                    if item is not None and item.children is not None:
+                        item.add_child(basename(key))
+                        self.cache.persist_children(parent,
+                                                    added=[basename(key)])
 
     def file_create_folder(self, path):
         "Add newly created directory to cache."
@@ -158,6 +312,7 @@ class DropboxClient(client.DropboxClient):
             if e.status == 400:
                 raise OperationFailedError(opname='file_create_folder', msg=str(e) )
             
+        self.cache.missing.discard_tree(path)
         self.cache.set(path, metadata)
 
     def file_copy(self, src, dst):
@@ -172,6 +327,7 @@ class DropboxClient(client.DropboxClient):
                 raise OperationFailedError(opname='file_copy', msg="User over storage quota")
             raise OperationFailedError(opname='file_copy', msg= str(e) )
             
+        self.cache.missing.discard_tree(dst)
         self.cache.set(dst, metadata)
 
     def file_move(self, src, dst):
@@ -187,6 +343,8 @@ class DropboxClient(client.DropboxClient):
             raise OperationFailedError(opname='file_copy', msg= str(e) )
             
         self.cache.pop(src, None)
+        self.cache.missing.add(src)
+        self.cache.missing.discard_tree(dst)
         self.cache.set(dst, metadata)
 
     def file_delete(self, path):
@@ -199,18 +357,107 @@ class DropboxClient(client.DropboxClient):
                 raise DirectoryNotEmptyError(path)
             raise OperationFailedError(opname='file_copy', msg=str(e) )
         self.cache.pop(path, None)
+        self.cache.missing.add(path)
 
     def put_file(self, path, f, overwrite=False):
+        """Uploads a string or a file like object. Files bigger than
+           CHUNKED_UPLOAD_THRESHOLD are sent in chunks."""
         try:
-            super(DropboxClient, self).put_file(path, f, overwrite=overwrite)
+            if isinstance(f, basestring):
+                length = len(f)
+            else:
+                f.seek(0, 2)
+                length = f.tell()
+                f.seek(0)
+            if length > CHUNKED_UPLOAD_THRESHOLD:
+                if isinstance(f, basestring):
+                    f = StringIO(f)
+                metadata = self.put_file_chunked(path, f, length, overwrite)
+            else:
+                metadata = super(DropboxClient, self).put_file(path, f,
+                                                    overwrite=overwrite)
         except rest.ErrorResponse, e:
             raise OperationFailedError(opname='file_copy', msg=str(e) )
         except TypeError, e:
             raise ResourceInvalidError("put_file", path)
         
-        self.cache.pop(dirname(path), None)
+        # The new rev and size replace the ones of the previous version,
+        # so reads after the upload get the new contents. Without
+        # overwrite, a conflict makes Dropbox store the file elsewhere.
+        if metadata.get('path', path).lower() != path.lower():
+            path = metadata['path']
+        self.cache.set(path, metadata)
+        return metadata
+
+    def put_file_chunked(self, path, f, length, overwrite=False,
+                         chunk_size=UPLOAD_CHUNK_SIZE):
+        """Uploads a file with the Dropbox chunked upload protocol.
+
+           Only one chunk is held in memory at a time. A failed chunk is
+           retried from the offset the server reports, and the upload
+           session is committed to path once all chunks are sent. If the
+           offset doesn't move forward UPLOAD_RETRIES times in a row, the
+           upload fails."""
+        upload_id, offset = None, 0
+        stalled = 0
+        while offset < length:
+            f.seek(offset)
+            reply = self._upload_chunk(f.read(min(chunk_size, length - offset)),
+                                       offset, upload_id)
+            if reply['offset'] <= offset:
+                stalled += 1
+                if stalled > UPLOAD_RETRIES:
+                    raise OperationFailedError(opname='put_file_chunked',
+                        path=path, msg="Upload stalled at offset %d" % offset)
+            else:
+                stalled = 0
+            upload_id, offset = reply['upload_id'], reply['offset']
+        return super(DropboxClient, self).commit_chunked_upload(path,
+            upload_id, overwrite=overwrite)
+
+    def _upload_chunk(self, data, offset, upload_id, retries=UPLOAD_RETRIES):
+        #  Sends one chunk of an upload session, retrying on server and
+        #  connection errors. Returns the reply with the upload_id and the
+        #  offset the server expects next.
+        params = {}
+        if upload_id is not None:
+            params = {'upload_id': upload_id, 'offset': offset}
+        url, params, headers = self.request("/chunked_upload", params,
+                                            method='PUT', content_server=True)
+        attempt = 0
+        while True:
+            try:
+                return self.rest_client.PUT(url, data, headers)
+            except rest.ErrorResponse, e:
+                if e.status == 400 and isinstance(e.body, dict) and \
+                        'offset' in e.body:
+                    # The server has a different offset than we expected,
+                    # continue from the offset it reports.
+                    return e.body
+                if e.status < 500 or attempt >= retries:
+                    raise
+            except socket.error, e:
+                if attempt >= retries:
+                    raise RemoteConnectionError(msg="Upload of a chunk " +
+                                                "failed: %s" % e)
+            attempt += 1
+            time.sleep(2 ** attempt)
+
+    def get_file_range(self, path, start, end, rev=None):
+        "Gets the bytes between offsets start and end (inclusive) of a file."
+        try:
+            response = super(DropboxClient, self).get_file(path, rev=rev,
+                start=start, length=end - start + 1)
+        except rest.ErrorResponse, e:
+            if e.status == 404:
+                raise ResourceNotFoundError(path)
+            raise OperationFailedError(opname='get_file', path=path,
+                                        msg=str(e) )
+        try:
+            return response.read()
+        finally:
+            response.close()
 
-            
     def media(self, path):
         try:
             info = super(DropboxClient, self).media( path )
@@ -243,7 +490,10 @@ class DropboxFS(FS):
               'mime_type': 'virtual/dropbox',
              }
 
-    def __init__(self, root=None, credentials=None, localtime=False, thread_synchronize=True):
+    def __init__(self, root=None, credentials=None, localtime=False, thread_synchronize=True,
+                 rest_client=None, cache_path=None, content_cache=None,
+                 cache_size=CACHE_MAX_ENTRIES, cache_bytes=CACHE_MAX_BYTES,
+                 sweep_interval=None, validations=None):
         self._root = root
         self._credentials = credentials
         
@@ -254,8 +504,32 @@ class DropboxFS(FS):
                 self._credentials['access_token'] = os.environ.get('DROPBOX_ACCESS_TOKEN')
         
         super(DropboxFS, self).__init__(thread_synchronize=thread_synchronize)
-        self.client = DropboxClient( oauth2_access_token = self._credentials['access_token'] )
+        #  rest_client allows pointing the client to a different endpoint,
+        #  for example a local fake Dropbox server.
+        self.client = DropboxClient( oauth2_access_token = self._credentials['access_token'],
+                                     rest_client = rest_client )
+        #  Metadata can be kept in an SQLite database at cache_path, so it
+        #  survives process restarts.
+        self._account = token_fingerprint(self._credentials['access_token'])
+        self.client.account = self._account
+        #  Whether the token was accepted is reported to validations, by
+        #  default the ValidationCache shared by the whole process.
+        if validations is not None:
+            self.client.validations = validations
+        if cache_path is not None:
+            self.client.cache.store = PersistentCache(cache_path, self._account)
+        #  The metadata cache keeps at most cache_size items (and about
+        #  cache_bytes of metadata), expired items are removed every
+        #  sweep_interval seconds if it's set.
+        self.client.cache.configure(cache_size, cache_bytes, sweep_interval)
+        #  Bodies of downloaded files can be kept in a ContentCache.
+        self.content_cache = content_cache
         self.localtime = localtime
+        self._delta_sync = None
+        #  Operations on one path are serialized by a lock of that path
+        #  instead of the lock of the whole filesystem, so a slow download
+        #  doesn't block other paths. Dropbox paths are case insensitive.
+        self._path_locks = StripedLock(normalize=lambda path: path.lower())
 
     def __repr__(self):
         args = (self.__class__.__name__, self._root)
@@ -279,26 +553,54 @@ class DropboxFS(FS):
             return False
     
     
-    @synchronize
-    def open(self, path, mode="rb", **kwargs):
+    def open(self, path, mode="rb", lazy=True, **kwargs):
         """Open the named file in the given mode.
 
         This method downloads the file contents into a local temporary file
         so that it can be worked on efficiently.  Any changes made to the
         file are only sent back to cloud storage when the file is flushed or closed.
+
+        When the file is opened only for reading and lazy is True, nothing
+        is downloaded up front. The returned file fetches just the byte
+        ranges that are read.
+
+        If the filesystem has a content cache, the file is read from the
+        cache as long as the cached revision is the current one.
         """
         path = abspath(normpath(path))
-        spooled_file = SpooledTemporaryFile(mode=mode, bufsize=MAX_BUFFER)
+        with self._path_locks.lock(path):
+            return self._open(path, mode, lazy, **kwargs)
+
+    def _open(self, path, mode, lazy, **kwargs):
+        if self.content_cache is not None and "w" not in mode:
+            cached_file = self._open_cached(path)
+            if cached_file is not None:
+                if readonly_mode(mode):
+                    return cached_file
+                return CloudFileBuffer(self, path, mode, cached_file,
+                               hash_contents=kwargs.get('hash_contents', False))
+        if lazy and readonly_mode(mode):
+            metadata = self.client.metadata(path)
+            if metadata.get('is_dir', False):
+                raise ResourceInvalidError(path)
+            rev = metadata.get('rev')
+            def fetch(start, end):
+                return self.client.get_file_range(path, start, end, rev)
+            return RemoteRangeFile(fetch, metadata.get('bytes', 0), mode)
+
+        spooled_file = SpooledTemporaryFile(max_size=MAX_BUFFER, mode="w+b")
 
         if "w" in mode:
             # Truncate the file if requested
-            self.client.put_file(path, "", True)
+            self._put(path, "", True)
         else:
             # Try to write to the spooled file, if path doesn't exist create it if
             # 'w' is in mode
             try:
-                spooled_file.write( self.client.get_file(path).read() )
+                self._copy_stream(self.client.get_file(path), spooled_file)
                 spooled_file.seek(0, 0)
+            except UnauthorizedError:
+                raise
             except:
                 if "w" not in mode:
                     raise ResourceNotFoundError(path)
@@ -307,17 +609,29 @@ class DropboxFS(FS):
 
 
         #  This will take care of closing the socket when it's done.
-        return RemoteFileBuffer(self,path,mode,spooled_file)
+        return CloudFileBuffer(self, path, mode, spooled_file,
+                               hash_contents=kwargs.get('hash_contents', False))
 
 
-    @synchronize
     def getcontents(self, path, mode="rb"):
         path = abspath(normpath(path))
-        return self.open(self, path, mode).read()
+        f = self.open(path, mode)
+        try:
+            return f.read()
+        finally:
+            f.close()
 
     def setcontents(self, path, data, *args, **kwargs):
         path = abspath(normpath(path))
-        self.client.put_file(path, data, overwrite=True)
+        with self._path_locks.lock(path):
+            self._put(path, data, True)
+
+    def _put(self, path, data, overwrite):
+        #  Uploads data to path. Cached bodies of the previous revisions
+        #  are dropped, so they can't be served or written back.
+        self.client.put_file(path, data, overwrite=overwrite)
+        if self.content_cache is not None:
+            self.content_cache.discard(self._account, path)
 
     def desc(self, path):
         return "%s in Dropbox" % path
@@ -354,10 +668,10 @@ class DropboxFS(FS):
         children = self.client.children(path)
         return self._listdir_helper(path, children, wildcard, full, absolute, dirs_only, files_only)
 
-    @synchronize
     def getinfo(self, path):
         path = abspath(normpath(path))
-        metadata = self.client.metadata(path)
+        with self._path_locks.lock(path):
+            metadata = self.client.metadata(path)
         return self._metadata_to_info(metadata, localtime=self.localtime)
 
     def copy(self, src, dst, *args, **kwargs):
@@ -408,7 +722,7 @@ class DropboxFS(FS):
             at specified path it will be wiped.
         
         """
-        self.client.put_file(path, '', overwrite=wipe)
+        self._put(path, '', wipe)
 
     def remove(self, path):
         path = abspath(normpath(path))
@@ -424,7 +738,93 @@ class DropboxFS(FS):
     
     def about(self):
         return self.client.account_info()    
+
+    def start_delta_sync(self, longpoll=True, interval=30):
+        """Keeps the metadata cache up to date with the /delta feed.
+
+        A daemon thread waits for changes (with longpoll_delta, or by
+        polling every interval seconds) and applies them to the cache.
+        While the feed works, cached items don't expire. If a call to
+        the feed fails, the cache falls back to CACHE_TTL expiry until
+        the feed recovers.
+        """
+        if self._delta_sync is not None:
+            return
+        self.client.sync_delta()
+        self.client.cache.expire = False
+        stop = self._delta_sync = threading.Event()
+        def run():
+            while not stop.is_set():
+                try:
+                    if longpoll:
+                        result = self.client.wait_for_delta(interval)
+                        if result.get('changes'):
+                            self.client.sync_delta()
+                        if result.get('backoff'):
+                            stop.wait(result['backoff'])
+                    elif stop.wait(interval):
+                        break
+                    else:
+                        self.client.sync_delta()
+                    self.client.cache.expire = False
+                except Exception:
+                    self.client.cache.expire = True
+                    stop.wait(interval)
+        thread = threading.Thread(target=run, name="DropboxFS delta sync")
+        thread.daemon = True
+        thread.start()
+
+    def stop_delta_sync(self):
+        """Stops the delta sync thread, cached items expire again."""
+        if self._delta_sync is not None:
+            self._delta_sync.set()
+            self._delta_sync = None
+            self.client.cache.expire = True
+
+    def close(self):
+        self.stop_delta_sync()
+        self.client.cache.stop_sweeper()
+        super(DropboxFS, self).close()
     
+    def _open_cached(self, path):
+        #  Returns the file from the content cache, downloading it into the
+        #  cache first if the cached revision is not the current one.
+        try:
+            metadata = self.client.metadata(path)
+        except ResourceNotFoundError:
+            return None
+        if metadata.get('is_dir', False):
+            raise ResourceInvalidError(path)
+        if metadata.get('bytes', 0) > self.content_cache.max_bytes:
+            #  Too big to be cached, it's read from Dropbox instead.
+            return None
+        rev = metadata.get('rev')
+        cached_file = self.content_cache.open(self._account, path, rev)
+        if cached_file is None:
+            try:
+                response = self.client.get_file(path, rev=rev)
+            except rest.ErrorResponse, e:
+                raise OperationFailedError(opname='get_file', path=path,
+                                            msg=str(e) )
+            try:
+                cached_file = self.content_cache.store(self._account, path,
+                                                       rev, response)
+            finally:
+                response.close()
+        return cached_file
+
+    def _copy_stream(self, response, spooled_file, chunk_size=CHUNK_SIZE):
+        #  Copies the HTTP response into the spooled file chunk by chunk,
+        #  so the whole body is never held in memory at once.
+        try:
+            while True:
+                data = response.read(chunk_size)
+                if not data:
+                    break
+                spooled_file.write(data)
+        finally:
+            response.close()
+
     def _checkRecursive(self, recursive, path):
         #  Checks if the new folder to be created is compatible with current
         #  value of recursive
@@ -442,12 +842,13 @@ class DropboxFS(FS):
           
     def _metadata_to_info(self, metadata, localtime=False):
         isdir = metadata.pop('is_dir', False)
+        path = metadata.pop('path', '')
         info = {
             'size': metadata.pop('bytes', 0),
             'isdir': isdir,
             'revision': metadata.pop('revision', 0),
-            'path': metadata.pop('path', 0),
-            'title': metadata.pop('path').split("/")[-1],
+            'path': path,
+            'title': path.split("/")[-1],
             'mime_type': metadata.pop('mime_type', 0)
         }
         try:
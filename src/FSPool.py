@@ -0,0 +1,116 @@
+"""
+FSPool
+========
+
+Reuse of filesystem instances across requests, so their metadata
+caches and HTTP connections stay warm.
+
+"""
+import time
+import threading
+from collections import OrderedDict
+
+# Max number of filesystems kept in a pool.
+FS_POOL_MAX_SIZE = 100
+# Filesystems unused for this many seconds are dropped (10 minutes).
+FS_POOL_IDLE_TIMEOUT = 600
+
+
+class FSPool(object):
+    """Keeps filesystems keyed by (user id, service, root, account).
+
+    account is the fingerprint of the token the filesystem was created
+    with (see CloudCache.token_fingerprint). A user, service and root
+    have at most one filesystem: when it's asked for with another
+    account, the credentials have changed, and the old filesystem is
+    dropped. Filesystems unused for idle_timeout seconds are dropped
+    as well, and when the pool holds more than max_size of them, the
+    least recently used ones go. Dropped filesystems are closed.
+
+    The filesystems are thread safe, so one of them can serve many
+    requests at the same time.
+
+    @param max_size: max number of filesystems, None means no limit
+    @param idle_timeout: seconds after which an unused filesystem is
+        dropped, None means never
+
+    """
+    def __init__(self, max_size=FS_POOL_MAX_SIZE,
+                 idle_timeout=FS_POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # (user id, service, root) -> [account, filesystem, last use],
+        # least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, service, root, account):
+        """Returns the pooled filesystem, or None."""
+        dropped = []
+        key = (user_id, service, root)
+        with self._lock:
+            self._drop_idle(dropped)
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] != account:
+                dropped.append(entry[1])
+                entry = None
+            if entry is not None:
+                entry[2] = time.time()
+                self._entries[key] = entry
+        self._close(dropped)
+        return entry[1] if entry is not None else None
+
+    def put(self, user_id, service, root, account, filesystem):
+        """Adds a filesystem, replacing the one the user had before."""
+        dropped = []
+        key = (user_id, service, root)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] is not filesystem:
+                dropped.append(entry[1])
+            self._entries[key] = [account, filesystem, time.time()]
+            self._drop_idle(dropped)
+            while (self.max_size is not None and
+                   len(self._entries) > self.max_size):
+                dropped.append(self._entries.popitem(last=False)[1][1])
+        self._close(dropped)
+
+    def invalidate(self, user_id, service=None):
+        """Drops the filesystems of a user (for one service or all)."""
+        dropped = []
+        with self._lock:
+            for key in self._entries.keys():
+                if key[0] == user_id and service in (None, key[1]):
+                    dropped.append(self._entries.pop(key)[1])
+        self._close(dropped)
+
+    def clear(self):
+        with self._lock:
+            dropped = [entry[1] for entry in self._entries.itervalues()]
+            self._entries.clear()
+        self._close(dropped)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop_idle(self, dropped):
+        #  Removes the filesystems unused for idle_timeout. The least
+        #  recently used come first, so only those are looked at.
+        if self.idle_timeout is None:
+            return
+        deadline = time.time() - self.idle_timeout
+        while self._entries:
+            key, entry = next(self._entries.iteritems())
+            if entry[2] > deadline:
+                break
+            del self._entries[key]
+            dropped.append(entry[1])
+
+    def _close(self, filesystems):
+        #  Closes dropped filesystems outside the lock, a failing close
+        #  mustn't break the request that triggered it.
+        for filesystem in filesystems:
+            try:
+                filesystem.close()
+            except Exception:
+                pass
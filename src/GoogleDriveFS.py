@@ -1,8 +1,10 @@
 import six
 import os
+import sys
+import socket
+import threading
 import datetime
 import time
-from UserDict import UserDict
 
 # Python filesystem imports
 from fs.base import FS
@@ -10,129 +12,280 @@ from fs.errors import UnsupportedError, \
                       CreateFailedError, ResourceInvalidError, \
                       ResourceNotFoundError, NoPathURLError, \
                       OperationFailedError, RemoteConnectionError
-from fs.remote import RemoteFileBuffer
 from fs.filelike import SpooledTemporaryFile
+from fs.path import abspath, normpath, pathsplit, iteratepath
+from CloudCache import CloudCache, CacheItem, PersistentCache, \
+                       token_fingerprint, CACHE_TTL, CACHE_MAX_ENTRIES, \
+                       CACHE_MAX_BYTES
+from RemoteFile import RemoteRangeFile, CloudFileBuffer, readonly_mode, \
+                       DOWNLOAD_BLOCK_SIZE
+from SingleFlight import SingleFlight
+from HttpPool import HttpPool, HTTP_POOL_SIZE
+from TokenValidation import UnauthorizedError, validations
+from contextlib import contextmanager
 
 # Imports specific to Google Drive service
 import httplib2
-from apiclient.discovery import build
-from apiclient.http import MediaInMemoryUpload
+from apiclient.discovery import build_from_document, DISCOVERY_URI
+from apiclient.http import MediaInMemoryUpload, MediaIoBaseUpload, \
+                          BatchHttpRequest
 from oauth2client.client import OAuth2Credentials
 from apiclient import errors
 
-# Items in cache are considered expired after 5 minutes.
-CACHE_TTL = 300
+# Services built from discovery documents, by (api, version). They are 
+# shared by all clients in the process, every request is executed with 
+# the Http object of its client.
+_discovery_services = {}
+_discovery_lock = threading.Lock()
+# Root folder ids of the accounts, by account fingerprint.
+_root_folder_ids = {}
+
 # Max size for spooling to memory before using disk (5M).
 MAX_BUFFER = 1024**2*5
+# Size of the chunks for resumable uploads, has to be a multiple of 256K (5M).
+UPLOAD_CHUNK_SIZE = 1024**2*5
+# How many times a failed upload chunk is retried before giving up.
+UPLOAD_RETRIES = 5
+# Max number of calls Google Drive accepts in one batch request.
+BATCH_SIZE = 100
 # Indicates the mimeType for a google drive folder
 GD_FOLDER = "application/vnd.google-apps.folder"
+# Fields fetched when only the existence or the type of a file is needed.
+FIELDS_MINIMAL = "id,title,mimeType,labels/trashed,parents/id"
+# Fields fetched for the children of a folder.
+FIELDS_LISTING = ("id,title,mimeType,labels/trashed,parents/id,fileSize," +
+                  "createdDate,modifiedDate,md5Checksum,etag,downloadUrl")
 
-class CacheItem(object):
-    """Represents a path in the cache. 
-    
-    There are two components to a path. It's individual metadata, 
-    and the children contained within it.
-    
-    """
-    def __init__(self, metadata=None, children=None, timestamp=None, 
-                 parents=None):
-        self.metadata = metadata
-        self.children = children
-        self.parents = parents
-        if timestamp is None:
-            timestamp = time.time()
-        self.timestamp = timestamp
-
-    def add_child(self, name, client=None):
-        if self.children is None:
-            if client != None:
-                # This is a fix. When you add a child to a folder that
-                # was still not listed, that folder gets only one
-                # child when you list it afterwards. So this fix
-                # first tries to check are the files/folders inside
-                # this directory on cloud.
-                client.children(self.metadata['id'])
-            else:
-                self.children = [name]
-        else:
-            if name not in self.children:
-                self.children.append(name)
-
-    def del_child(self, name):
-        if self.children is None:
-            return
-        try:
-            i = self.children.index(name)
-        except ValueError:
-            return
-        self.children.pop(i)
-
-    def _get_expired(self):
-        if self.timestamp <= time.time() - CACHE_TTL:
-            return True
-    expired = property(_get_expired)
+def _trashed(metadata):
+    # Checks if the metadata belongs to a trashed file
+    return (metadata.get('trashed', False) or 
+            metadata.get('labels', {}).get('trashed', False))
 
-    def renew(self):
-        self.timestamp = time.time()
+def _sort_key(metadata):
+    # Of many files with the same title in a folder, paths resolve to 
+    # the oldest one
+    return metadata.get('createdDate', '')
 
+def _quote(value):
+    # Quotes a string for the q parameter of files().list
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
 
-class GoogleDriveCache(UserDict):
-    def __init__(self, client):
+class GoogleDriveCache(CloudCache):
+    def __init__(self, client, **kwargs):
         self._client = client
-        UserDict.__init__(self)
+        CloudCache.__init__(self, **kwargs)
         
     def set(self, path, metadata, children=None, parents=None):
         self[path] = CacheItem(metadata, children=children, parents=parents)
         if parents != None:
             for parent in parents:
-                if self.has_key(parent):
-                    self.get(parent).add_child(path, self._client)
+                item = self.get(parent)
+                if item:
+                    item.add_child(path, self._client)
+                    self.persist_children(parent, added=[path])
+        self.index(metadata, parents)
+
+    def index(self, metadata, parents=None):
+        """Adds a file to the path index, under the given parents or 
+            the parents in its metadata."""
+        if 'title' not in metadata or _trashed(metadata):
+            return
+        if parents is None:
+            parents = [parent['id'] for parent in 
+                       metadata.get('parents', [])]
+        for parent in parents:
+            self.paths.add(parent, metadata['title'], metadata['id'], 
+                           _sort_key(metadata))
+            self.missing.discard((parent, metadata['title']))
 
     def pop(self, path, default=None):
-        value = UserDict.pop(self, path, default)
-        if( value.parents != None ):
+        self.paths.discard(path)
+        value = CloudCache.pop(self, path, default)
+        if( value != None and value.parents != None ):
             for parent in value.parents:
-                if self.has_key(parent):
-                    self.get(parent).del_child(value.metadata['id'])
+                item = self.get(parent)
+                if item:
+                    item.del_child(value.metadata['id'])
+                    self.persist_children(parent, 
+                                          removed=[value.metadata['id']])
         return value
 
 
+def _discovery_service(api, version):
+    """Returns the service of an API. The discovery document is fetched
+        and parsed only the first time."""
+    with _discovery_lock:
+        service = _discovery_services.get((api, version))
+        if service is None:
+            uri = DISCOVERY_URI.replace('{api}', api)
+            uri = uri.replace('{apiVersion}', version)
+            resp, document = httplib2.Http().request(uri)
+            if resp.status >= 400:
+                raise RemoteConnectionError("Can't fetch the discovery " +
+                                            "document: " + str(resp))
+            service = build_from_document(document, http=httplib2.Http())
+            _discovery_services[(api, version)] = service
+        return service
+
+
 class GoogleDriveClient(object):
-    def __init__(self, credentials):
+    def __init__(self, credentials, upload_chunk_size=UPLOAD_CHUNK_SIZE,
+                 http_pool_size=HTTP_POOL_SIZE):
         self.credentials = credentials
-        self.service = self._build_service()
+        self.upload_chunk_size = upload_chunk_size
+        # httplib2.Http isn't thread safe, every request borrows an 
+        # authorized Http object from the pool.
+        self.http_pool = HttpPool(credentials, http_pool_size)
+        # Fingerprint of the credentials, set by GoogleDriveFS.
+        self.account = None
+        # ValidationCache the outcomes of the requests are reported to.
+        self.validations = validations
         self.cache = GoogleDriveCache(self)
-        self._retry = 0
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        # Position in the changes feed, see sync_changes().
+        self.largest_change_id = None
+        self._flight = SingleFlight()
         
-    def _build_service(self):
-        http = httplib2.Http()
-        http = self.credentials.authorize(http);
-        service = build('drive', 'v2', http=http)
-        return service
+    def _get_service(self):
+        # Built on first use, so creating a client makes no request
+        return _discovery_service('drive', 'v2')
+    service = property(_get_service)
+    
+    @contextmanager
+    def _connection(self):
+        """Borrows an Http object from the pool. 
+        
+        Whether the credentials were accepted is reported to validations,
+            a 401 response raises UnauthorizedError.
+        """
+        with self.http_pool.connection() as http:
+            try:
+                yield http
+            except errors.HttpError, e:
+                self._validated(e.resp.status)
+                raise
+        self._validated(200)
+    
+    def _validated(self, status):
+        if self.account is None:
+            return
+        if status == 401:
+            self.validations.failed(self.account)
+            raise UnauthorizedError(msg="Google Drive rejected the " +
+                                        "credentials")
+        self.validations.succeeded(self.account)
+    
+    def _execute(self, request):
+        """Executes a request with an Http object from the pool."""
+        with self._connection() as http:
+            return request.execute(http=http)
+    
+    def _request(self, uri, **kwargs):
+        """Sends a plain HTTP request with an Http object from the pool.
+        
+        @return: (response, content)
+        """
+        with self._connection() as http:
+            resp, content = http.request(uri, **kwargs)
+            if resp.status == 401:
+                self._validated(resp.status)
+        return resp, content
     
     def _retry_operation(self, method, *args):
         """Method retries a operation. 
         
-        Sometimes access_token expires and we need to rebuild it using
+        Sometimes access_token expires and we need to refresh it using
         the refresh token. This method does that and retries the
-        operation that failed.
+        operation that failed, once per thread. The service and the 
+        pooled connections are kept.
         
         """
-        if self._retry == 0:
-            self._retry = 1
-            self.service = self._build_service()
-            return method(*args)
-        else:
+        if getattr(self._local, 'retrying', False):
+            if isinstance(sys.exc_info()[1], UnauthorizedError):
+                raise
             raise RemoteConnectionError("Most probable reasons: " +
                   "access token has expired or user credentials are invalid.")
+        self._local.retrying = True
+        try:
+            self._refresh_token()
+            return method(*args)
+        finally:
+            self._local.retrying = False
+    
+    def _refresh_token(self):
+        """Gets a new access token, the Http objects of the pool use it 
+            from their next request on."""
+        token = self.credentials.access_token
+        with self._refresh_lock:
+            if self.credentials.access_token != token:
+                # Another thread has just refreshed it
+                return
+            try:
+                self.credentials.refresh(httplib2.Http())
+            except Exception, e:
+                if self.account is not None:
+                    self.validations.failed(self.account)
+                raise UnauthorizedError(msg="Can't refresh the access " +
+                                            "token: %s" % e)
+    
+    def _media_body(self, content, mimetype=None):
+        """Wraps the content of a file for upload.
+        
+        Strings that fit into one chunk are sent in a single request.
+        Everything else is uploaded resumably, upload_chunk_size bytes
+        at a time, so only one chunk is held in memory.
+        @param content: string or a file like object with read, seek 
+            and tell methods
+        """
+        if mimetype is None:
+            mimetype = 'application/octet-stream'
+        if isinstance(content, basestring):
+            if len(content) <= self.upload_chunk_size:
+                return MediaInMemoryUpload(content, mimetype)
+            content = six.BytesIO(content)
+        return MediaIoBaseUpload(content, mimetype, 
+                                 chunksize=self.upload_chunk_size,
+                                 resumable=True)
+    
+    def _execute_upload(self, request):
+        """Executes an upload request chunk by chunk.
+        
+        Transient failures (5xx responses and connection errors) are 
+            retried and the upload resumes from the last offset 
+            acknowledged by Google Drive.
+        """
+        if request.resumable is None:
+            return self._execute(request)
+        response = None
+        retries = 0
+        while response is None:
+            try:
+                with self._connection() as http:
+                    status, response = request.next_chunk(http=http)
+                retries = 0
+            except errors.HttpError, e:
+                if e.resp.status < 500 or retries >= UPLOAD_RETRIES:
+                    raise
+                retries += 1
+                time.sleep(2 ** retries)
+            except (socket.error, httplib2.HttpLib2Error), e:
+                if retries >= UPLOAD_RETRIES:
+                    raise
+                retries += 1
+                time.sleep(2 ** retries)
+        return response
     
     def get_file(self, path):
         item = self.cache.get(path)
-        if not item or item.metadata is None or item.expired:
+        if (not item or item.metadata is None or self.cache.stale(item) or
+                not item.covers(None)):
             try: 
-                metadata = self.service.files().get(fileId=path).execute()
+                metadata = self._execute(
+                                    self.service.files().get(fileId=path))
             except errors.HttpError, e:
                 if e.resp.status == 404:
+                    self.cache.missing.add(path)
                     raise ResourceNotFoundError("Source file doesn't exist")
                 raise OperationFailedError(opname='get_file', 
                                            msg=e.resp.reason)
@@ -144,75 +297,388 @@ class GoogleDriveClient(object):
             metadata = item.metadata
             
         download_url = metadata.get('downloadUrl')
-        resp, content = self.service._http.request(download_url)
+        resp, content = self._request(download_url)
         if resp.status == 200:
             return content
         else:
             raise OperationFailedError(opname="get_file", msg=str(resp))
+
+    def get_file_range(self, path, start, end, revision=None):
+        """Gets the bytes between offsets start and end (inclusive) 
+            of a file, using a HTTP Range request.
         
+        Download URLs expire. When one is rejected, a new one is fetched
+            and the request is sent once more.
+        @param revision: md5Checksum (or etag) of the file when it was
+            opened. If the file has changed since, the read fails 
+            instead of mixing bytes of two revisions.
+        """
+        metadata = self.metadata(path, FIELDS_LISTING)
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        try:
+            resp, content = self._download(path, metadata, revision, 
+                                           headers)
+        except UnauthorizedError:
+            # The access token expired
+            self._refresh_token()
+            resp = None
+        if resp is None or resp.status == 403:
+            metadata = self._fetch_download_url(path)
+            resp, content = self._download(path, metadata, revision, 
+                                           headers)
+        if resp.status == 206:
+            total = resp.get('content-range', '').rpartition('/')[2]
+            if (revision is not None and total.isdigit() and 
+                    'fileSize' in metadata and 
+                    int(total) != int(metadata['fileSize'])):
+                raise OperationFailedError(opname="get_file_range", 
+                                           path=path, msg="The file " +
+                                           "changed while it was read")
+            return content
+        elif resp.status == 200:
+            # The server ignored the Range header and sent everything
+            return content[start:end + 1]
+        else:
+            raise OperationFailedError(opname="get_file_range", 
+                                       msg=str(resp))
+    
+    def _download(self, path, metadata, revision, headers):
+        """Requests the body of a file from its downloadUrl.
+        
+        @return: (response, content)
+        """
+        current = metadata.get('md5Checksum') or metadata.get('etag')
+        if revision is not None and current != revision:
+            raise OperationFailedError(opname="get_file_range", path=path,
+                                       msg="The file changed while it " +
+                                           "was read")
+        download_url = metadata.get('downloadUrl')
+        if not download_url:
+            raise ResourceInvalidError(path)
+        return self._request(download_url, headers=headers)
+    
+    def _fetch_download_url(self, path):
+        """Fetches the metadata of a file with a new downloadUrl."""
+        try:
+            metadata = self._execute(self.service.files().get(
+                                            fileId=path, 
+                                            fields=FIELDS_LISTING))
+        except errors.HttpError, e:
+            if e.resp.status == 404:
+                self.cache.missing.add(path)
+                raise ResourceNotFoundError(path)
+            raise OperationFailedError(opname='metadata', path=path,
+                                       msg=e.resp.reason )
+        except:
+            return self._retry_operation(self._fetch_download_url, path)
+        item = self._cache_metadata(path, metadata, FIELDS_LISTING)
+        return dict(item.metadata.items())
+        
+    def metadata(self, path, fields=None):
+        """Gets metadata for a given path.
         
-    def metadata(self, path):
-        """Gets metadata for a given path."""
+        @param fields: Fields to fetch, e.g. FIELDS_MINIMAL. None means
+            the full metadata. Partial metadata from the cache is 
+            upgraded when more fields are asked for.
+        """
         item = self.cache.get(path)
-        if not item or item.metadata is None or item.expired:
-            try:
-                metadata = self.service.files().get(fileId=path).execute()
-            except errors.HttpError, e:
-                if e.resp.status == 404:
-                    raise ResourceNotFoundError(path)
-                raise OperationFailedError(opname='metadata', path=path,
-                                           msg=e.resp.reason )
-            except:
-                return self._retry_operation(self.metadata, path)
-            if metadata.get('trashed', False):
+        if (not item or item.metadata is None or self.cache.stale(item) or 
+                not item.covers(fields)):
+            if path in self.cache.missing:
                 raise ResourceNotFoundError(path)
-            item = self.cache[path] = CacheItem(metadata)
+            # Concurrent lookups of the same file share one request.
+            item = self._flight.do(('metadata', path, fields), 
+                                   self._fetch_metadata, path, fields)
             
         # Copy the info so the caller cannot affect our cache.
         return dict(item.metadata.items())
     
-    def children(self, path):
-        """Gets children of a given path."""
-        update = False
+    def _fetch_metadata(self, path, fields):
+        """Fetches metadata of a given path into the cache.
+        
+        @return: The cache item of the path
+        """
         item = self.cache.get(path)
-        if item:
-            if item.expired:
-                update = True
-            else:
-                if item.metadata["mimeType"] != GD_FOLDER:
-                    raise ResourceInvalidError(path)
-            if not item.children:
-                update = True
+        fresh = (item and item.metadata is not None and 
+                 not self.cache.stale(item))
+        if fresh and item.covers(fields):
+            # Another thread has just fetched it.
+            return item
+        param = {'fileId': path}
+        if fields is not None:
+            if fresh:
+                # Keep the fields which are already cached
+                fields = ",".join(sorted(set(fields.split(",")) | 
+                                         set(item.fields.split(","))))
+            param['fields'] = fields
+        try:
+            metadata = self._execute(self.service.files().get(**param))
+        except errors.HttpError, e:
+            if e.resp.status == 404:
+                self.cache.missing.add(path)
+                raise ResourceNotFoundError(path)
+            raise OperationFailedError(opname='metadata', path=path,
+                                       msg=e.resp.reason )
+        except:
+            return self._retry_operation(self._fetch_metadata, path, fields)
+        if _trashed(metadata):
+            self.cache.missing.add(path)
+            raise ResourceNotFoundError(path)
+        if fresh:
+            # Upgrade the partial metadata, keep the children
+            item.metadata = metadata
+            item.fields = fields
+            self.cache.persist(path)
         else:
-            update = True
-        if update:
-            try:
-                metadata = self.service.files().get(fileId=path).execute()
-                if metadata["mimeType"] != GD_FOLDER:
-                    raise ResourceInvalidError(path)
-                param = {"q":  "'%s' in parents" % path}
-                children = []
-                filesResource = self.service.files().list(**param).execute()
-                contents = filesResource.pop('items')
-                for child in contents:
-                    if child.get('trashed', False):
-                        continue
-                    children.append(child['id'])
-                    self.cache[child['id']] = CacheItem(child, parents=[path])
-                item = self.cache[path] = CacheItem(metadata, children)
-            except errors.HttpError, e:
-                if e.resp.status == 404:
-                    raise ResourceNotFoundError(path)
-                if not item or e.resp.status != 304:
-                    raise OperationFailedError(opname='metadata',path=path, 
-                                               msg=e.resp.reason)
-                # We have an item from cache (perhaps expired), 
-                # but it's still valid (as far as GoogleDrive is 
-                # concerned), so just renew it and keep using it.
-                item.renew()
-            except:
-                return self._retry_operation(self.children, path)
-        return item.children
+            item = self.cache[path] = CacheItem(metadata, fields=fields)
+        return item
+    
+    def _cache_metadata(self, file_id, metadata, fields, parents=None):
+        """Caches metadata fetched by a listing or a batch.
+        
+        A fresh item is updated in place, so its children stay cached,
+            and fields it had beyond the fetched ones are kept. A stale
+            item is replaced, but keeps the parents it's known to have.
+        @return: The cache item of the file
+        """
+        item = self.cache.get(file_id)
+        if item is not None and item.parents:
+            parents = sorted(set(item.parents) | set(parents or []))
+        if (item is not None and item.metadata is not None and 
+                not self.cache.stale(item)):
+            if item.covers(fields):
+                item.metadata.update(metadata)
+            else:
+                item.metadata = metadata
+                item.fields = fields
+            item.parents = parents
+            self.cache.missing.discard(file_id)
+            self.cache.persist(file_id)
+            return item
+        item = self.cache[file_id] = CacheItem(metadata, parents=parents, 
+                                               fields=fields)
+        return item
+    
+    def metadata_many(self, ids, fields=None):
+        """Gets metadata for many files at once.
+        
+        Files missing in the cache are fetched with batch requests,
+            up to BATCH_SIZE of them in one HTTP round trip.
+        @param ids: Ids of the files
+        @param fields: Fields to fetch, None means the full metadata
+        @return: Dictionary of file id -> metadata. Files that don't 
+            exist or are trashed are left out.
+        @raise OperationFailedError: If some of the files couldn't be
+            fetched, the others are cached anyway
+        """
+        result = {}
+        missing = []
+        failures = []
+        for file_id in ids:
+            if file_id in self.cache.missing:
+                continue
+            item = self.cache.get(file_id)
+            if (not item or item.metadata is None or 
+                    self.cache.stale(item) or not item.covers(fields)):
+                if file_id not in result:
+                    missing.append(file_id)
+                    result[file_id] = None
+            else:
+                result[file_id] = dict(item.metadata.items())
+        for i in range(0, len(missing), BATCH_SIZE):
+            requests = []
+            for file_id in missing[i:i + BATCH_SIZE]:
+                param = {'fileId': file_id}
+                if fields is not None:
+                    param['fields'] = fields
+                requests.append((file_id, self.service.files().get(**param)))
+            responses, failed = self._execute_batch(requests)
+            failures.extend(failed)
+            for file_id, metadata in responses:
+                if metadata is None or _trashed(metadata):
+                    self.cache.missing.add(file_id)
+                    continue
+                self._cache_metadata(file_id, metadata, fields)
+                result[file_id] = dict(metadata.items())
+        if failures:
+            raise OperationFailedError(opname='metadata_many', 
+                                       msg=str(failures[0][1]))
+        return dict((file_id, metadata) for file_id, metadata 
+                    in result.iteritems() if metadata is not None)
+    
+    def _execute_batch(self, requests):
+        """Executes many requests in one batch HTTP request.
+        
+        @param requests: List of (request_id, request) pairs
+        @return: List of (request_id, response) pairs, response is None
+            if the resource wasn't found, and list of (request_id, 
+            exception) pairs of the requests which failed. The caller
+            applies the responses before it reports the failures.
+        """
+        responses = []
+        failures = []
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses.append((request_id, response))
+            elif (isinstance(exception, errors.HttpError) and 
+                  exception.resp.status == 404):
+                responses.append((request_id, None))
+            else:
+                failures.append((request_id, exception))
+        batch = BatchHttpRequest(callback=callback)
+        for request_id, request in requests:
+            batch.add(request, request_id=request_id)
+        try:
+            with self._connection() as http:
+                batch.execute(http=http)
+        except errors.HttpError, e:
+            raise OperationFailedError(opname='batch', msg=e.resp.reason)
+        except:
+            return self._retry_operation(self._execute_batch, requests)
+        return responses, failures
+    
+    def children(self, path):
+        """Gets children of a given path.
+        
+        Concurrent listings of the same folder share one listing.
+        """
+        return list(self._flight.do(('children', path), self._list_children,
+                                    path))
+    
+    def _list_children(self, path):
+        return [child_id for child_id, metadata in self.ichildren(path)]
+    
+    def ichildren(self, path, max_results=None, fields=FIELDS_LISTING):
+        """Iterates over the children of a given path.
+        
+        The listing follows nextPageToken, and the children of each 
+            page are yielded (and cached) as soon as the page arrives.
+            The list of children of the folder itself is cached once 
+            the last page was read.
+        @param max_results: Max number of children in one page
+        @param fields: Fields of the children to fetch, by default
+            FIELDS_LISTING. None fetches the full metadata.
+        @return: Iterator of (id, metadata) pairs
+        """
+        item = self.cache.get(path)
+        if (item and item.children and item.metadata is not None and 
+                not self.cache.stale(item)):
+            if item.metadata["mimeType"] != GD_FOLDER:
+                raise ResourceInvalidError(path)
+            for child_id in list(item.children):
+                child = self.cache.get(child_id)
+                if child and child.metadata is not None and \
+                        child.covers(fields):
+                    yield child_id, dict(child.metadata.items())
+                else:
+                    yield child_id, None
+            return
+        
+        metadata = self.metadata(path, FIELDS_MINIMAL)
+        if metadata["mimeType"] != GD_FOLDER:
+            raise ResourceInvalidError(path)
+        item = self.cache.get(path)
+        metadata_fields = item.fields if item is not None else FIELDS_MINIMAL
+        param = {"q":  "'%s' in parents" % path}
+        if max_results:
+            param["maxResults"] = max_results
+        if fields:
+            param["fields"] = "nextPageToken,items(%s)" % fields
+        children = []
+        titles = []
+        while True:
+            page = self._list_page(path, param)
+            for child in page.get('items', []):
+                if _trashed(child):
+                    continue
+                children.append(child['id'])
+                self._cache_metadata(child['id'], child, fields, [path])
+                if 'title' in child:
+                    titles.append((child['title'], child['id'], 
+                                   _sort_key(child)))
+                yield child['id'], dict(child.items())
+            if not page.get('nextPageToken'):
+                break
+            param["pageToken"] = page['nextPageToken']
+        item = self.cache.get(path)
+        self.cache[path] = CacheItem(metadata, children, 
+                                     parents=item.parents if item else None,
+                                     fields=metadata_fields)
+        if len(titles) == len(children):
+            self.cache.paths.set_children(path, titles)
+    
+    def resolve(self, root_id, path):
+        """Resolves a path of titles, e.g. /Folder/Sub/file.txt, to an id.
+        
+        Every folder on the way is looked up in the path index, which
+            is filled by listings and by earlier lookups. A title which
+            isn't indexed costs one files().list request for that title
+            in its parent, unless the whole listing of the parent is
+            indexed (then it doesn't exist). When a folder has many 
+            children with the same title, the oldest one is used.
+        @param root_id: Id of the folder the path starts in
+        @raise ResourceNotFoundError: If a part of the path doesn't exist
+        @return: Id of the file or folder
+        """
+        file_id = root_id
+        for title in iteratepath(path):
+            file_id = self._resolve_child(file_id, title, path)
+        return file_id
+    
+    def _resolve_child(self, parent_id, title, path):
+        ttl = CACHE_TTL if self.cache.expire else None
+        child_id = self.cache.paths.lookup(parent_id, title, ttl)
+        if child_id is not None:
+            return child_id
+        if (self.cache.paths.is_complete(parent_id, ttl) or 
+                (parent_id, title) in self.cache.missing):
+            raise ResourceNotFoundError(path)
+        # Concurrent lookups of the same title share one request.
+        child_id = self._flight.do(('resolve', parent_id, title), 
+                                   self._find_child, parent_id, title)
+        if child_id is None:
+            raise ResourceNotFoundError(path)
+        return child_id
+    
+    def _find_child(self, parent_id, title):
+        """Looks up the children of a folder with a given title, and 
+            adds them to the cache and the path index.
+        @return: Id of the oldest of them, or None
+        """
+        param = {
+            "q": "'%s' in parents and title = %s and trashed = false" % 
+                 (parent_id, _quote(title)),
+            "fields": "nextPageToken,items(%s)" % FIELDS_LISTING
+            }
+        found = []
+        while True:
+            page = self._list_page(parent_id, param)
+            for child in page.get('items', []):
+                if _trashed(child) or child.get('title') != title:
+                    continue
+                self._cache_metadata(child['id'], child, FIELDS_LISTING, 
+                                     [parent_id])
+                self.cache.index(child, [parent_id])
+                found.append((_sort_key(child), child['id']))
+            if not page.get('nextPageToken'):
+                break
+            param["pageToken"] = page['nextPageToken']
+        if not found:
+            self.cache.missing.add((parent_id, title))
+            return None
+        return min(found)[1]
+    
+    def _list_page(self, path, param):
+        """Fetches one page of a files().list request."""
+        try:
+            return self._execute(self.service.files().list(**param))
+        except errors.HttpError, e:
+            if e.resp.status == 404:
+                raise ResourceNotFoundError(path)
+            raise OperationFailedError(opname='children', path=path, 
+                                       msg=e.resp.reason)
+        except:
+            return self._retry_operation(self._list_page, path, param)
         
     def file_create_folder(self, parent_id, title):
         """Add newly created directory to cache."""
@@ -222,7 +688,7 @@ class GoogleDriveClient(object):
             "mimeType": "application/vnd.google-apps.folder"
             }
         try:
-            metadata = self.service.files().insert(body=body).execute()
+            metadata = self._execute(self.service.files().insert(body=body))
         except errors.HttpError, e:
             if e.resp.status == 405:
                     raise ResourceInvalidError(parent_id)
@@ -243,10 +709,10 @@ class GoogleDriveClient(object):
         body = {"parents": [{"id": parent_id}]}
             
         try:
-            metadata = self.service.files().copy(
+            metadata = self._execute(self.service.files().copy(
                                     fileId = file_id,
                                     body = body
-                                    ).execute()
+                                    ))
         except errors.HttpError, e:
             if e.resp.status == 404:
                 raise ResourceNotFoundError("Parent or source " +
@@ -260,10 +726,10 @@ class GoogleDriveClient(object):
     
     def update_file(self, file_id, new_file):
         try: 
-            metadata = self.service.files().update(
+            metadata = self._execute(self.service.files().update(
                                                   fileId = file_id,
                                                   body = new_file
-                                                  ).execute()
+                                                  ))
         except errors.HttpError, e:
             if e.resp.status == 404:
                 raise ResourceNotFoundError("Parent or source " +
@@ -286,9 +752,11 @@ class GoogleDriveClient(object):
     def update_file_content(self, file_id, content):
         """ Updates a file on google drive """
         item = self.cache.get(file_id, None)
-        if not item or item.metadata is None or item.expired:
+        if (not item or item.metadata is None or self.cache.stale(item) or
+                not item.covers(None)):
             try:
-                metadata = self.service.files().get(fileId=file_id).execute()
+                metadata = self._execute(
+                                    self.service.files().get(fileId=file_id))
             except errors.HttpError, e:
                 raise OperationFailedError(opname='update_file_content', 
                                            msg=e.resp.reason)
@@ -299,13 +767,13 @@ class GoogleDriveClient(object):
         else:
             metadata = item.metadata    
             
-        media_body = MediaInMemoryUpload(content)
+        media_body = self._media_body(content, metadata.get('mimeType'))
         try: 
-            updated_file = self.service.files().update(
+            updated_file = self._execute_upload(self.service.files().update(
                                                   fileId = file_id,
                                                   body = metadata,
                                                   media_body=media_body
-                                                  ).execute()
+                                                  ))
         except errors.HttpError, e:
             raise OperationFailedError(opname='update_file_content', 
                                        msg=e.resp.reason)
@@ -320,7 +788,7 @@ class GoogleDriveClient(object):
                                                     
     def file_delete(self, path):
         try:
-            self.service.files().delete(fileId=path).execute()
+            self._execute(self.service.files().delete(fileId=path))
         except errors.HttpError, e:
             if e.resp.status == 404:
                 raise ResourceNotFoundError(path)
@@ -328,20 +796,47 @@ class GoogleDriveClient(object):
                                        msg=e.resp.reason)
         except:
             return self._retry_operation(self.file_delete, path) 
-        self.cache.pop(path, None)     
+        self.cache.pop(path, None)
+        self.cache.missing.add(path)     
+    
+    def file_delete_many(self, ids):
+        """Deletes many files, up to BATCH_SIZE of them in one HTTP
+            round trip.
+        @raise ResourceNotFoundError: If some of the files don't exist,
+            the others are deleted anyway
+        @raise OperationFailedError: If some of the files couldn't be
+            deleted, the others are deleted anyway
+        """
+        not_found = []
+        failures = []
+        for i in range(0, len(ids), BATCH_SIZE):
+            requests = [(file_id, self.service.files().delete(fileId=file_id))
+                        for file_id in ids[i:i + BATCH_SIZE]]
+            responses, failed = self._execute_batch(requests)
+            failures.extend(failed)
+            for file_id, response in responses:
+                if response is None:
+                    not_found.append(file_id)
+                self.cache.pop(file_id, None)
+                self.cache.missing.add(file_id)
+        if failures:
+            raise OperationFailedError(opname='file_delete_many', 
+                                       msg=str(failures[0][1]))
+        if not_found:
+            raise ResourceNotFoundError(", ".join(not_found))
         
     def put_file(self, parent_id, title, content, description=None):
-        media_body = MediaInMemoryUpload(content)
+        media_body = self._media_body(content)
         body = {
             'title': title,
             'description': description, 
             'parents': [{'id': parent_id}]
             }
         try:
-            metadata = self.service.files().insert(
+            metadata = self._execute_upload(self.service.files().insert(
                                                   body=body,
                                                   media_body=media_body
-                                                  ).execute()
+                                                  ))
         except errors.HttpError, e:
             raise OperationFailedError(opname='put_file', msg=e.resp.reason)
         except TypeError, e:
@@ -354,10 +849,87 @@ class GoogleDriveClient(object):
 
     def about(self):
         try:
-            info = self.service.about().get().execute()
+            info = self._execute(self.service.about().get())
             return info
         except:
             return self._retry_operation(self.about)
+    
+    def sync_changes(self, max_results=1000):
+        """Applies the changes feed to the cache.
+        
+        The first call only remembers the current largestChangeId and
+            invalidates everything cached before it, the persistent 
+            store is shared with other processes and is kept. Every 
+            further call reads
+            the changes made since the previous one, page by page, and
+            applies them to the cache in bulk.
+        """
+        if self.largest_change_id is None:
+            self.largest_change_id = int(self.about()['largestChangeId'])
+            self.cache.invalidate()
+            return
+        param = {
+            'startChangeId': self.largest_change_id + 1,
+            'includeDeleted': True,
+            'maxResults': max_results
+            }
+        largest_change_id = self.largest_change_id
+        while True:
+            try:
+                result = self._execute(self.service.changes().list(**param))
+            except errors.HttpError, e:
+                raise OperationFailedError(opname='sync_changes', 
+                                           msg=e.resp.reason)
+            for change in result.get('items', []):
+                self._apply_change(change)
+            largest_change_id = max(largest_change_id, 
+                                    int(result['largestChangeId']))
+            if not result.get('nextPageToken'):
+                break
+            param['pageToken'] = result['nextPageToken']
+        self.largest_change_id = largest_change_id
+    
+    def _apply_change(self, change):
+        """Applies one item of the changes feed to the cache.
+        
+        Removed and trashed files are dropped from the cache and from
+            the children of their parents, everything else is updated
+            and moved to the children of its current parents.
+        """
+        file_id = change['fileId']
+        metadata = change.get('file')
+        # The feed knows better than a lookup which found nothing
+        self.cache.missing.discard(file_id)
+        item = self.cache.get(file_id)
+        old_parents = set()
+        children = None
+        if item is not None:
+            children = item.children
+            old_parents.update(item.parents or [])
+            if item.metadata:
+                old_parents.update(parent['id'] for parent in 
+                                   item.metadata.get('parents', []))
+        if change.get('deleted') or metadata is None or _trashed(metadata):
+            new_parents = []
+            self.cache.pop(file_id, None)
+        else:
+            new_parents = [parent['id'] for parent in 
+                           metadata.get('parents', [])]
+            self.cache[file_id] = CacheItem(metadata, children, 
+                                            parents=new_parents)
+            # It may have been renamed or moved
+            self.cache.paths.discard(file_id)
+            self.cache.index(metadata, new_parents)
+        for parent_id in old_parents.difference(new_parents):
+            parent = self.cache.get(parent_id)
+            if parent is not None:
+                parent.del_child(file_id)
+                self.cache.persist_children(parent_id, removed=[file_id])
+        for parent_id in new_parents:
+            parent = self.cache.get(parent_id)
+            if parent is not None and parent.children is not None:
+                parent.add_child(file_id)
+                self.cache.persist_children(parent_id, added=[file_id])
         
         
 class GoogleDriveFS(FS):
@@ -365,6 +937,10 @@ class GoogleDriveFS(FS):
         
     @attention: when setting variables in os.environ please note that
     GD_TOKEN_EXPIRY has to be in format: "%Y, %m, %d, %H, %M, %S, %f"
+    
+    @note: Paths are file ids by default. With use_paths=True they are
+        paths of titles instead, e.g. /Folder/Sub/file.txt, which are 
+        resolved to ids with GoogleDriveClient.resolve().
     """
     
     __name__ = "Google Drive"
@@ -381,8 +957,16 @@ class GoogleDriveFS(FS):
               'atomic.setconetns' : True
               }
     
-    def __init__(self, root=None, credentials=None, thread_synchronize=True):
-        self._root = root
+    def __init__(self, root=None, credentials=None, thread_synchronize=True,
+                 upload_chunk_size=UPLOAD_CHUNK_SIZE, cache_path=None,
+                 content_cache=None, http_pool_size=HTTP_POOL_SIZE,
+                 use_paths=False, cache_size=CACHE_MAX_ENTRIES, 
+                 cache_bytes=CACHE_MAX_BYTES, sweep_interval=None,
+                 validations=None):
+        if root == '' or root == "/":
+            root = None
+        # Resolved on first use, see _get_root()
+        self._root_id = root
         def _getDateTimeFromString(time):
             # Parses string into datetime object
             if time:
@@ -431,27 +1015,61 @@ class GoogleDriveFS(FS):
                                         credentials.get('token_uri'), 
                                         None
                                         )
-        self.client = GoogleDriveClient(self._credentials)
-             
-        if (self._root == None or root == '' or self._root=="/"):
-            # Root fix, if root is not set get the root folder id
-            # from the user information returned by about   
-            about = self.client.about()
-            self._root = about.get("rootFolderId")
+        self.client = GoogleDriveClient(self._credentials, 
+                                        upload_chunk_size, http_pool_size)
+        # Metadata can be kept in an SQLite database at cache_path, 
+        # so it survives process restarts.
+        self._account = token_fingerprint(self._credentials.refresh_token or
+                                          self._credentials.access_token)
+        self.client.account = self._account
+        # Whether the credentials were accepted is reported to 
+        # validations, by default the ValidationCache shared by the 
+        # whole process.
+        if validations is not None:
+            self.client.validations = validations
+        if cache_path is not None:
+            self.client.cache.store = PersistentCache(cache_path, 
+                                                      self._account)
+        # The metadata cache keeps at most cache_size items (and about 
+        # cache_bytes of metadata), expired items are removed every 
+        # sweep_interval seconds if it's set.
+        self.client.cache.configure(cache_size, cache_bytes, sweep_interval)
+        # Bodies of downloaded files can be kept in a ContentCache.
+        self.content_cache = content_cache
+        self._use_paths = use_paths
+        # Titles are only indexed when they are used to resolve paths.
+        self.client.cache.paths.enabled = use_paths
+        self._changes_sync = None
         
         # Initialize super class FS    
         super(GoogleDriveFS, self).__init__(
             thread_synchronize=thread_synchronize
             )
         
+    def _get_root(self):
+        """Id of the root folder. 
+        
+        If no root was given, the root folder of the account is used. 
+            Its id is fetched with about() the first time it's needed 
+            and remembered for the account in the whole process.
+        """
+        if self._root_id is None:
+            root_id = _root_folder_ids.get(self._account)
+            if root_id is None:
+                root_id = self.client.about().get("rootFolderId")
+                _root_folder_ids[self._account] = root_id
+            self._root_id = root_id
+        return self._root_id
+    _root = property(_get_root)
+    
     def __repr__(self):
-        args = (self.__class__.__name__, self._root)
+        args = (self.__class__.__name__, self._root_id or "root")
         return '<FileSystem: %s - Root Directory: %s>' % args
     
     __str__ = __repr__
     
     def __unicode__(self):
-        args = (self.__class__.__name__, self._root)
+        args = (self.__class__.__name__, self._root_id or "root")
         return u'<FileSystem: %s - Root Directory: %s>' % args
     
     
@@ -459,23 +1077,18 @@ class GoogleDriveFS(FS):
         """Updates contents of an existing file
         
         @param path: Id of the file for which to update content
-        @param contents: Contents to write to the file  
+        @param contents: Contents to write to the file, as a string or
+            a file like object which is uploaded in chunks
         @return: Id of the updated file
         
         """
-        path = self._normpath(path)
-        
-        if isinstance(contents, basestring):
-            string_data = contents
-        else:
+        if not isinstance(contents, basestring):
             try:
                 contents.seek(0)
-                string_data = contents.read()
             except:
                 raise ResourceInvalidError("Unsupported type")
-            
         
-        return self.client.update_file_content(path, string_data)['id']
+        return self.client.update_file_content(path, contents)['id']
     
     def setcontents(self, path, contents="", chunk_size=64*1024, **kwargs):
         """Sets new content to remote file
@@ -501,7 +1114,7 @@ class GoogleDriveFS(FS):
             contents = contents.encode(encoding=encoding, errors=errors)
         
         
-        return self._update(path, contents)
+        return self._update(self._normpath(path), contents)
 
     def createfile(self, path, wipe=True, **kwargs):
         """Creates an empty file always.
@@ -525,6 +1138,13 @@ class GoogleDriveFS(FS):
         
         """
         
+        if self._use_paths:
+            parent_path, title = pathsplit(abspath(normpath(path)))
+            parent_id = self._normpath(parent_path)
+            description = kwargs.get("description", "")
+            return self.client.put_file(parent_id, title, "", 
+                                        description)['id']
+        
         # Google drive doesn't work with paths. So a slight
         # work around is needed.
         parts = path.split("/")
@@ -549,7 +1169,8 @@ class GoogleDriveFS(FS):
         return self.client.put_file(parent_id, title, "", description)['id']
         
     def open(self, path, mode='r',  buffering=-1, encoding=None, 
-             errors=None, newline=None, line_buffering=False, **kwargs):
+             errors=None, newline=None, line_buffering=False, lazy=True,
+             **kwargs):
         """ Open the named file in the given mode.
 
         This method downloads the file contents into a local temporary
@@ -558,13 +1179,47 @@ class GoogleDriveFS(FS):
             the file is flushed or closed.
         @param path: Id of the file to be opened
         @param mode: In which mode to open the file
+        @param lazy: If True and the file is opened only for reading,
+            nothing is downloaded up front. Only the byte ranges that
+            are actually read get fetched.
+        @note: If the filesystem has a content cache, the file is read
+            from the cache as long as the cached md5Checksum (or etag)
+            matches the current one.
         @raise ResourceNotFoundError: If given path doesn't exist and 
             'w' is not in mode
-        @return: RemoteFileBuffer object 
+        @return: CloudFileBuffer object, or RemoteRangeFile object
+            for lazy read only files
         
         """
-        path = self._normpath(path)
-        spooled_file = SpooledTemporaryFile(mode=mode, bufsize=MAX_BUFFER)
+        if self._use_paths:
+            # The buffer writes back through setcontents(path)
+            buffer_path = path
+            try:
+                path = self._normpath(path)
+            except ResourceNotFoundError:
+                if "w" not in mode and "a" not in mode:
+                    raise
+                path = self.createfile(buffer_path)
+        else:
+            buffer_path = path = self._normpath(path)
+        if self.content_cache is not None and "w" not in mode:
+            cached_file = self._open_cached(path)
+            if cached_file is not None:
+                if readonly_mode(mode):
+                    return cached_file
+                return CloudFileBuffer(self, buffer_path, mode, cached_file,
+                               hash_contents=kwargs.get('hash_contents', False))
+        if lazy and readonly_mode(mode):
+            metadata = self.client.metadata(path, FIELDS_LISTING)
+            if metadata.get('downloadUrl') and 'fileSize' in metadata:
+                # Every range is read from the revision opened here
+                revision = metadata.get('md5Checksum') or metadata.get('etag')
+                def fetch(start, end):
+                    return self.client.get_file_range(path, start, end, 
+                                                      revision)
+                return RemoteRangeFile(fetch, metadata['fileSize'], mode)
+            
+        spooled_file = SpooledTemporaryFile(max_size=MAX_BUFFER, mode="w+b")
         
         #  Truncate the file if requested
         if "w" in mode:
@@ -576,11 +1231,45 @@ class GoogleDriveFS(FS):
             except Exception, e:
                 if "w" not in mode and "a" not in mode:
                     raise ResourceNotFoundError("%r" % e)
+                elif self._use_paths:
+                    path = self.createfile(buffer_path, True)
                 else:
-                    path = self.createfile(path, True)
-        return RemoteFileBuffer(self,path,mode,spooled_file)
+                    buffer_path = path = self.createfile(path, True)
+        return CloudFileBuffer(self, buffer_path, mode, spooled_file,
+                               hash_contents=kwargs.get('hash_contents', False))
    
         
+    def _open_cached(self, path):
+        """Returns the file from the content cache, downloading it into
+            the cache first if the cached revision is not the current one.
+            The body is streamed into the cache with range requests, so
+            it's never held in memory as a whole.
+        @return: File opened for reading, or None if the file doesn't 
+            exist, can't be downloaded (e.g. Google Docs) or is bigger
+            than the content cache
+        """
+        try:
+            metadata = self.client.metadata(path, FIELDS_LISTING)
+        except ResourceNotFoundError:
+            return None
+        revision = metadata.get('md5Checksum') or metadata.get('etag')
+        if (not metadata.get('downloadUrl') or not revision or 
+                'fileSize' not in metadata):
+            return None
+        size = int(metadata['fileSize'])
+        if size > self.content_cache.max_bytes:
+            return None
+        cached_file = self.content_cache.open(self._account, path, revision)
+        if cached_file is None:
+            def fetch(start, end):
+                return self.client.get_file_range(path, start, end, 
+                                                  revision)
+            body = RemoteRangeFile(fetch, size, 
+                                   blocksize=DOWNLOAD_BLOCK_SIZE)
+            cached_file = self.content_cache.store(self._account, path, 
+                                                   revision, body)
+        return cached_file
+        
     def is_root(self, path):
         """Checks if the given path is the root folder of this 
             instance of GoogleDriveFS
@@ -603,7 +1292,8 @@ class GoogleDriveFS(FS):
             in one folder.
         @return: Id of the copied file
         """
-        return self.client.file_copy(src, dst)['id']
+        return self.client.file_copy(self._normpath(src), 
+                                     self._normpath(dst))['id']
     
     def copydir(self, src, dst, overwrite=False, ignore_errors=False, 
                 chunk_size=16384):
@@ -617,12 +1307,28 @@ class GoogleDriveFS(FS):
     def rename(self, src, dst):
         """
         @param src: Id of the file to be renamed 
-        @param dst: New title of the file
+        @param dst: New title of the file, or its new path with use_paths.
+            A file renamed to a path in another folder is moved there 
+            from the folder of src, its other parents are kept.
         @raise UnsupportedError: If trying to rename the root directory 
         @return: Id of the renamed file
         """
         if self.is_root(path = src):
             raise UnsupportedError("Can't rename the root directory") 
+        if self._use_paths:
+            src_parent = pathsplit(abspath(normpath(src)))[0]
+            src_parent_id = self._normpath(src_parent)
+            dst_parent, title = pathsplit(abspath(normpath(dst)))
+            dst_parent_id = self._normpath(dst_parent)
+            src = self._normpath(src)
+            f = self.client.metadata(src)
+            f['title'] = title
+            if dst_parent_id != src_parent_id:
+                f['parents'] = [parent for parent in f.get('parents', []) 
+                                if parent['id'] != src_parent_id]
+                f['parents'].append({"id": dst_parent_id})
+            return self.client.update_file(src, f)['id']
+        src = self._normpath(src)
         f = self.client.metadata(src)
         f['title'] = dst
         return self.client.update_file(src, f)['id']
@@ -632,27 +1338,41 @@ class GoogleDriveFS(FS):
         @param path: id of the folder to be deleted
         @return: None if removal was successful 
         """
-        path = self._normpath(path)
-        
         if self.is_root(path = path):
             raise UnsupportedError("Can't remove the root directory")   
         if self.isdir(path = path):
             raise ResourceInvalidError("Specified path is a directory. " +
                                        "Please use removedir.")
-        self.client.file_delete(path)
+        self.client.file_delete(self._normpath(path))
+    
+    def removemany(self, paths):
+        """Removes many files with batch requests, up to 100 files
+            in one HTTP round trip.
+        @param paths: ids of the files to be deleted
+        @raise ResourceInvalidError: If one of the paths is a directory,
+            nothing is deleted in that case
+        """
+        for path in paths:
+            if self.is_root(path = path):
+                raise UnsupportedError("Can't remove the root directory")
+        paths = [self._normpath(path) for path in paths]
+        metadata = self.client.metadata_many(paths)
+        for path in paths:
+            if metadata.get(path, {}).get("mimeType") == GD_FOLDER:
+                raise ResourceInvalidError("%s is a directory. " % path +
+                                           "Please use removedir.")
+        self.client.file_delete_many(paths)
     
     def removedir(self, path):
         """
         @param path: id of the folder to be deleted
         @return: None if removal was successful 
         """        
-        path = self._normpath(path)
-        
         if not self.isdir(path):
             raise ResourceInvalidError("Specified path is not a directory")
         if self.is_root(path = path):
             raise UnsupportedError("remove the root directory")
-        self.client.file_delete(path)
+        self.client.file_delete(self._normpath(path))
     
     def makedir(self, path, recursive=False, allow_recreate=False ):
         """
@@ -672,6 +1392,8 @@ class GoogleDriveFS(FS):
         @return: Id of the created directory
         
         """
+        if self._use_paths:
+            return self._makedir_path(path, recursive, allow_recreate)
         parts = path.split("/")
         if parts[0] == "":
             parent_id = self._root
@@ -698,6 +1420,27 @@ class GoogleDriveFS(FS):
                 title = parts[1]
             return self.client.file_create_folder(parent_id, title)['id']
     
+    def _makedir_path(self, path, recursive, allow_recreate):
+        """makedir() for paths of titles. Existing parent folders are
+            reused when creating recursively."""
+        parent_path, title = pathsplit(abspath(normpath(path)))
+        try:
+            parent_id = self._normpath(parent_path)
+        except ResourceNotFoundError:
+            if not recursive:
+                raise
+            parent_id = self._makedir_path(parent_path, True, True)
+        if allow_recreate:
+            try:
+                folder_id = self.client.resolve(parent_id, title)
+            except ResourceNotFoundError:
+                pass
+            else:
+                if self.client.metadata(folder_id, FIELDS_MINIMAL).get(
+                                            "mimeType") == GD_FOLDER:
+                    return folder_id
+        return self.client.file_create_folder(parent_id, title)['id']
+    
     def move(self, src, dst, overwrite=False, chunk_size=16384):
         """
         @note: Google drive can have many parents for one file, 
@@ -713,9 +1456,9 @@ class GoogleDriveFS(FS):
         if self.isdir(src):
             raise ResourceInvalidError("Specified src is a directory. " +
                                        "Please use movedir.")
-        
-        f = self.client.get_file(src)
-        f['parents'] = [{"id":dst}]
+        src = self._normpath(src)
+        f = self.client.metadata(src)
+        f['parents'] = [{"id":self._normpath(dst)}]
         return self.client.update_file(src, f)['id']
     
     def movedir(self, src, dst, overwrite=False, ignore_errors=False, 
@@ -733,8 +1476,9 @@ class GoogleDriveFS(FS):
         if( self.isfile(src) ):
             raise ResourceInvalidError("Specified src is a file. " +
                                        "Please use move.")
-        f = self.client.get_file(src)
-        f['parents'] = [{"id":dst}]
+        src = self._normpath(src)
+        f = self.client.metadata(src)
+        f['parents'] = [{"id":self._normpath(dst)}]
         
         return self.client.update_file(src, f)['id']
 
@@ -745,8 +1489,8 @@ class GoogleDriveFS(FS):
         @param path: Id of the file/folder to check
         """
         path = self._normpath(path)
-        info = self.getinfo(path)
-        return info['isdir']
+        metadata = self.client.metadata(path, FIELDS_MINIMAL)
+        return metadata.get("mimeType") == GD_FOLDER
 
     
     def isfile(self, path):
@@ -755,8 +1499,8 @@ class GoogleDriveFS(FS):
         @param path: Id of the file/folder to check
         """
         path = self._normpath(path)
-        info = self.getinfo(path)
-        return not info['isdir']
+        metadata = self.client.metadata(path, FIELDS_MINIMAL)
+        return metadata.get("mimeType") != GD_FOLDER
     
     
     def exists(self, path):
@@ -764,9 +1508,8 @@ class GoogleDriveFS(FS):
         
         @param path: Id of the file/folder to check
         """
-        path = self._normpath(path)
         try:
-            self.client.metadata(path)
+            self.client.metadata(self._normpath(path), FIELDS_MINIMAL)
             return True
         except RemoteConnectionError, e:
             raise e
@@ -803,6 +1546,10 @@ class GoogleDriveFS(FS):
         @type files_only: bool 
         @return: a list of unicode paths       
         """
+        if self._use_paths:
+            return list(self.ilistdir(path, wildcard, full, absolute, 
+                                      dirs_only, files_only, 
+                                      fields=FIELDS_LISTING))
         path = self._normpath(path)
         flist = self.client.children(path)
         
@@ -832,13 +1579,105 @@ class GoogleDriveFS(FS):
             returned by getinfo.
             
         """     
-        return [(p, self.getinfo(p))
-                    for p in self.listdir(path,
-                                          wildcard=wildcard,
-                                          full=full,
-                                          absolute=absolute,
-                                          dirs_only=dirs_only,
-                                          files_only=files_only)]
+        if self._use_paths:
+            return list(self.ilistdirinfo(path, wildcard, full, absolute, 
+                                          dirs_only, files_only, 
+                                          fields=FIELDS_LISTING))
+        paths = self.listdir(path,
+                             wildcard=wildcard,
+                             full=full,
+                             absolute=absolute,
+                             dirs_only=dirs_only,
+                             files_only=files_only)
+        # Metadata missing in the cache is fetched with batch requests
+        ids = [self._normpath(p) for p in paths]
+        metadata = self.client.metadata_many(ids, FIELDS_LISTING)
+        infos = []
+        for p, file_id in zip(paths, ids):
+            if file_id in metadata:
+                infos.append((p, self._metadata_to_info(metadata[file_id])))
+            else:
+                infos.append((p, self.getinfo(p)))
+        return infos
+    
+    def ilistdir(self, path=None,
+                       wildcard=None,
+                       full=False,
+                       absolute=False,
+                       dirs_only=False,
+                       files_only=False,
+                       max_results=None,
+                       fields=None):
+        """ Generator yielding the files and directories under a given
+            path.
+            
+        Unlike listdir, entries are yielded as soon as each page of the
+            listing arrives, so the first entries of a very large folder
+            are available right away.
+        @param max_results: Max number of entries fetched in one page
+        @param fields: Fields fetched for each entry, e.g. 
+            "id,title,mimeType"
+        @see: listdir for the other parameters
+        """
+        for p, child_id, metadata in self._ilistdir_helper(path, wildcard, 
+                                                 full, absolute, dirs_only, 
+                                                 files_only, max_results, 
+                                                 fields):
+            yield p
+    
+    def ilistdirinfo(self, path=None,
+                           wildcard=None,
+                           full=False,
+                           absolute=False,
+                           dirs_only=False,
+                           files_only=False,
+                           max_results=None,
+                           fields=None):
+        """ Generator yielding paths and path info under a given path.
+        
+        The info comes straight from the listing, no extra requests 
+            are made for it.
+        @see: ilistdir for the parameters
+        """
+        for p, child_id, metadata in self._ilistdir_helper(path, wildcard, 
+                                                 full, absolute, dirs_only, 
+                                                 files_only, max_results, 
+                                                 fields):
+            if metadata is None:
+                yield p, self._metadata_to_info(
+                                            self.client.metadata(child_id))
+            else:
+                yield p, self._metadata_to_info(metadata)
+    
+    def _ilistdir_helper(self, path, wildcard, full, absolute, dirs_only, 
+                         files_only, max_results, fields):
+        """Yields the (path, id, metadata) triples which pass the 
+            filters. With use_paths, the paths are made of titles."""
+        folder_id = self._normpath(path)
+        for child_id, metadata in self.client.ichildren(folder_id, 
+                                                        max_results, fields):
+            minimal = None
+            if dirs_only or files_only:
+                if metadata is None or "mimeType" not in metadata:
+                    minimal = self.client.metadata(child_id, FIELDS_MINIMAL)
+                    isdir = minimal.get("mimeType") == GD_FOLDER
+                else:
+                    isdir = metadata["mimeType"] == GD_FOLDER
+                if (dirs_only and not isdir) or (files_only and isdir):
+                    continue
+            if self._use_paths:
+                if metadata is not None and "title" in metadata:
+                    name = metadata["title"]
+                else:
+                    name = (minimal or self.client.metadata(
+                                    child_id, FIELDS_MINIMAL))["title"]
+                entries = self._listdir_helper(path or "/", [name], wildcard,
+                                               full, absolute, False, False)
+            else:
+                entries = self._listdir_helper('', [child_id], wildcard, 
+                                               full, absolute, False, False)
+            for p in entries:
+                yield p, child_id, metadata
 
 
     def getinfo(self, path):
@@ -896,11 +1735,57 @@ class GoogleDriveFS(FS):
                                float(info['quotaBytesTotal']) )
         return info
     
+    def start_changes_sync(self, interval=30, disable_expiry=True):
+        """Keeps the metadata cache up to date with the changes feed.
+        
+        A daemon thread reads the changes feed every interval seconds
+            and applies it to the cache.
+        @param interval: seconds between two reads of the feed
+        @param disable_expiry: If True, cached items don't expire 
+            while the feed works. If reading the feed fails, items 
+            expire after CACHE_TTL again until the feed recovers.
+        """
+        if self._changes_sync is not None:
+            return
+        self.client.sync_changes()
+        if disable_expiry:
+            self.client.cache.expire = False
+        stop = self._changes_sync = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.client.sync_changes()
+                    if disable_expiry:
+                        self.client.cache.expire = False
+                except Exception:
+                    self.client.cache.expire = True
+        thread = threading.Thread(target=run, 
+                                  name="GoogleDriveFS changes sync")
+        thread.daemon = True
+        thread.start()
+        
+    def stop_changes_sync(self):
+        """Stops the changes sync thread, cached items expire again."""
+        if self._changes_sync is not None:
+            self._changes_sync.set()
+            self._changes_sync = None
+            self.client.cache.expire = True
+    
+    def close(self):
+        self.stop_changes_sync()
+        self.client.cache.stop_sweeper()
+        self.client.http_pool.clear()
+        super(GoogleDriveFS, self).close()
+    
     def _normpath(self, path):
         """ Method normalises the path for google drive.
         
         @return: normaliesed path as a string
         """
+        if self._use_paths:
+            if path is None or normpath(path) in ("", "/"):
+                return self._root
+            return self.client.resolve(self._root, path)
         if path == None or path=="":
             return self._root
         elif len( path.split("/") ) > 2 :
@@ -938,9 +1823,3 @@ class GoogleDriveFS(FS):
             }
         info.update(metadata)
         return info
-    
-"""
-Problems:
-  - Flush and close, both call write contents and because of that 
-    the file on cloud is overwrite twice...
-"""
\ No newline at end of file
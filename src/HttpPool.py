@@ -0,0 +1,100 @@
+"""
+HttpPool
+========
+
+A pool of authorized HTTP connections, shared by the threads using one
+cloud service client.
+
+"""
+import socket
+import threading
+from contextlib import contextmanager
+
+import httplib2
+
+# Max number of Http objects (and so open connections) of one pool.
+HTTP_POOL_SIZE = 10
+
+
+class HttpPool(object):
+    """Hands out authorized httplib2.Http objects to threads.
+
+    httplib2.Http is not thread safe, so a thread borrows an Http object
+    for as long as its request runs and gives it back afterwards. The
+    objects keep their connections open, so returned objects are reused
+    with keep-alive. A thread that already holds an object gets the same
+    one again. At most max_size objects exist; when all of them are
+    borrowed, other threads wait until one is returned. An object whose
+    request failed with a connection error is thrown away, because its
+    connection may be half read.
+
+    Http objects authorized by oauth2client refresh the access token
+    themselves when a request gets a 401.
+
+    @param credentials: oauth2client credentials used to authorize the
+        Http objects
+    @param max_size: max number of Http objects
+    @param timeout: socket timeout of the connections in seconds
+
+    """
+    def __init__(self, credentials, max_size=HTTP_POOL_SIZE, timeout=None):
+        self.credentials = credentials
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._local = threading.local()
+
+    @contextmanager
+    def connection(self):
+        """Borrows an Http object for the duration of a with block."""
+        local = self._local
+        if getattr(local, 'http', None) is not None:
+            yield local.http
+            return
+        http = self._acquire()
+        local.http = http
+        broken = False
+        try:
+            yield http
+        except (socket.error, httplib2.HttpLib2Error):
+            broken = True
+            raise
+        finally:
+            local.http = None
+            self._release(http, broken)
+
+    def clear(self):
+        """Drops all idle Http objects, closing their connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for http in idle:
+            self._close(http)
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self.credentials.authorize(
+                                    httplib2.Http(timeout=self.timeout))
+        except:
+            self._slots.release()
+            raise
+
+    def _release(self, http, broken=False):
+        if broken:
+            self._close(http)
+        else:
+            with self._lock:
+                self._idle.append(http)
+        self._slots.release()
+
+    def _close(self, http):
+        for connection in getattr(http, 'connections', {}).values():
+            try:
+                connection.close()
+            except Exception:
+                pass
@@ -0,0 +1,126 @@
+"""
+RemoteFile
+========
+
+File objects shared by the cloud filesystems.
+
+"""
+import hashlib
+
+from fs.filelike import FileLikeBase
+from fs.remote import RemoteFileBuffer
+
+# Minimal number of bytes requested with one HTTP Range request (64K).
+RANGE_BLOCK_SIZE = 1024*64
+# Number of bytes requested at once when a whole file is streamed, e.g.
+# into a content cache (4M).
+DOWNLOAD_BLOCK_SIZE = 1024**2*4
+
+
+class RemoteRangeFile(FileLikeBase):
+    """A read-only file that lazily fetches byte ranges of a remote file.
+
+    Nothing is downloaded when the object is created. Every read asks
+    the cloud service only for the bytes it needs (at least blocksize
+    of them), so reading the head of a large file or seeking around in
+    it never transfers the whole body.
+
+    @param fetch: callable fetch(start, end) returning the bytes between
+        offsets start and end (both inclusive)
+    @param size: size of the remote file in bytes
+    @param blocksize: minimal number of bytes requested at once
+
+    """
+    def __init__(self, fetch, size, mode="rb", blocksize=RANGE_BLOCK_SIZE):
+        self.mode = mode
+        self._fetch = fetch
+        self._size = int(size)
+        self._pos = 0
+        self._blocksize = blocksize
+        super(RemoteRangeFile, self).__init__(bufsize=blocksize)
+
+    def _read(self, sizehint=-1):
+        if self._pos >= self._size:
+            return None
+        if sizehint is None or sizehint < 0:
+            end = self._size - 1
+        else:
+            end = min(self._pos + max(sizehint, self._blocksize),
+                      self._size) - 1
+        data = self._fetch(self._pos, end)
+        if not data:
+            return None
+        self._pos += len(data)
+        return data
+
+    def _seek(self, offset, whence=0):
+        if whence == 0:
+            pos = offset
+        elif whence == 1:
+            pos = self._pos + offset
+        elif whence == 2:
+            pos = self._size + offset
+        else:
+            raise ValueError("Invalid whence: %r" % whence)
+        self._pos = max(pos, 0)
+
+    def _tell(self):
+        return self._pos
+
+
+class CloudFileBuffer(RemoteFileBuffer):
+    """A RemoteFileBuffer that uploads its contents only when needed.
+
+    RemoteFileBuffer writes the contents back on every flush and close,
+    so a flush followed by a close uploads the file twice. This buffer
+    remembers whether the contents changed since the last successful
+    upload and skips the upload if they didn't.
+
+    @param hash_contents: if True, an md5 digest of the uploaded
+        contents is kept as well, and rewriting the same bytes doesn't
+        trigger a new upload either
+
+    """
+    def __init__(self, fs, path, mode, rfile=None, write_on_flush=True,
+                 hash_contents=False):
+        self._hash_contents = hash_contents
+        self._uploaded_digest = None
+        super(CloudFileBuffer, self).__init__(fs, path, mode, rfile,
+                                              write_on_flush)
+
+    def _setcontents(self):
+        if not self._changed:
+            return
+        digest = None
+        if self._hash_contents:
+            digest = self._digest()
+            if digest == self._uploaded_digest:
+                self._changed = False
+                return
+        super(CloudFileBuffer, self)._setcontents()
+        # Reached only if the upload didn't raise
+        self._uploaded_digest = digest
+        self._changed = False
+
+    def _digest(self):
+        #  Computes the md5 digest of the whole buffer, leaving the file
+        #  position unchanged.
+        if not self._eof:
+            self._fillbuffer()
+        md5 = hashlib.md5()
+        pos = self.wrapped_file.tell()
+        self.wrapped_file.seek(0)
+        try:
+            while True:
+                data = self.wrapped_file.read(RANGE_BLOCK_SIZE)
+                if not data:
+                    break
+                md5.update(data)
+        finally:
+            self.wrapped_file.seek(pos)
+        return md5.hexdigest()
+
+
+def readonly_mode(mode):
+    """Checks if a file opened in the given mode can only be read."""
+    return not ("w" in mode or "a" in mode or "+" in mode)
@@ -1,17 +1,65 @@
 from DropboxFS import DropboxFS
 from GoogleDriveFS import GoogleDriveFS
 from SkyDriveFS import SkyDriveFS
+from CloudCache import token_fingerprint
+from FSPool import FSPool
+from TokenValidation import validations as token_validations
+from fs.base import FS
 import dropbox
 from cloudutils_config import * 
 from oauth2client.client import OAuth2WebServerFlow
 from datetime import datetime
 
+# Filesystems shared by all factories of the process, so the caches and
+# connections of a user's filesystem are reused by the next request.
+fs_pool = FSPool()
+
 class CloudServiceFactory(object):
+    """Builds the filesystems of a user.
+    
+    Credentials aren't checked with an extra request. The filesystem is
+    returned right away, and its first real call validates them: a 401
+    from any call raises TokenValidation.UnauthorizedError and marks the
+    token as rejected. get_fs then returns the URL to authorize again
+    (for the services that have one) instead of a filesystem, until the
+    validation window of the token ends.
+    
+    @param pool: FSPool to reuse filesystems from, by default fs_pool
+    @param validations: ValidationCache with the outcomes of the tokens,
+        by default the one shared by the whole process. The filesystems
+        it builds report to it, and its window sets how long an outcome
+        is trusted.
+    """
+    def __init__(self, pool=None, validations=None):
+        if pool is None:
+            pool = fs_pool
+        if validations is None:
+            validations = token_validations
+        self.pool = pool
+        self.validations = validations
+    
     def get_fs(self, uri, user=None, callback_url=None, request = None):
         service_name = uri.split("://")[0]
         root = uri.split("://")[1]
         cloudutils_settings = user.get('cloudutils_settings', {})
         credentials = cloudutils_settings.get(service_name, {})
+        user_id = user.get('id')
+        
+        if request == None and credentials:
+            account = self._account(service_name, credentials)
+            if self.validations.valid(account) is False:
+                # The token was rejected, drop its filesystems and let
+                # the user authorize again
+                self.pool.invalidate(user_id, service_name)
+                if service_name == 'dropbox':
+                    return self._dropbox_authorize_url(callback_url)
+                elif service_name == 'google_drive':
+                    return self._google_drive_authorize_url(callback_url)
+            # Reuse the user's filesystem if it was created with the same
+            # credentials
+            filesystem = self.pool.get(user_id, service_name, root, account)
+            if filesystem is not None:
+                return filesystem
         
         filesystem = None
         if(service_name == 'dropbox'):
@@ -19,29 +67,55 @@ class CloudServiceFactory(object):
         elif(service_name == 'google_drive'):
             filesystem = self._build_google_drive_fs(user, credentials, root, callback_url, request)
         elif(service_name == 'sky_drive'):
-            filesystem = SkyDriveFS(None, credentials)
+            filesystem = SkyDriveFS(None, credentials,
+                                    validations=self.validations)
         
+        if isinstance(filesystem, FS):
+            self.pool.put(user_id, service_name, root, filesystem._account,
+                          filesystem)
         return filesystem
+    
+    def _dropbox_authorize_url(self, callback_url):
+        #Remove everything from user credentials
+        #Session nije ovo
+        self.session={}
+        flow = dropbox.client.DropboxOAuth2Flow(
+                                                CFG_DROPBOX_KEY, 
+                                                CFG_DROPBOX_SECRET, 
+                                                callback_url, self.session, 
+                                                CFG_DROPBOX_CSRF_TOKEN
+                                                )
+        
+        url = flow.start()
+        return url
+    
+    def _google_drive_authorize_url(self, callback_url):
+        #Remove everything from user credentials
+        #Session nije ovo
+        flow = OAuth2WebServerFlow(CFG_GOOGLE_DRIVE_CLIENT_ID, 
+                                   CFG_GOOGLE_DRIVE_CLIENT_SECRET, 
+                                   CFG_GOOGLE_DRIVE_SCOPE,
+                                   callback_url)
+        url = flow.step1_get_authorize_url()
+        return url
+    
+    def _account(self, service_name, credentials):
+        # Fingerprint of the credentials, the same the filesystem uses
+        if service_name in ('google_drive', 'sky_drive'):
+            token = (credentials.get('refresh_token') or 
+                     credentials.get('access_token'))
+        else:
+            token = credentials.get('access_token')
+        return token_fingerprint(token)
         
     def _build_dropbox_fs(self, user, credentials, root=None, callback_url=None, request=None):
         if(request == None ):
             try:
-                filesystem = DropboxFS(root, credentials)
-                filesystem.about()
-                return filesystem
+                # The credentials are validated by the first real call
+                return DropboxFS(root, credentials,
+                                 validations=self.validations)
             except:
-                #Remove everything from user credentials
-                #Session nije ovo
-                self.session={}
-                flow = dropbox.client.DropboxOAuth2Flow(
-                                                        CFG_DROPBOX_KEY, 
-                                                        CFG_DROPBOX_SECRET, 
-                                                        callback_url, self.session, 
-                                                        CFG_DROPBOX_CSRF_TOKEN
-                                                        )
-                
-                url = flow.start()
-                return url
+                return self._dropbox_authorize_url(callback_url)
           
         elif(request != None):
             try:
@@ -62,7 +136,8 @@ class CloudServiceFactory(object):
                            }
             #self.update_cloudutils_settings(newSettings)
             
-            filesystem = DropboxFS(root, {"access_token": access_token})
+            filesystem = DropboxFS(root, {"access_token": access_token},
+                                   validations=self.validations)
             return filesystem
     
     
@@ -70,18 +145,11 @@ class CloudServiceFactory(object):
     def _build_google_drive_fs(self, user, credentials, root=None, callback_url=None, request=None):
         if(request == None ):
             try:
-                filesystem = GoogleDriveFS(root, credentials)
-                filesystem.about()
-                return filesystem
+                # The credentials are validated by the first real call
+                return GoogleDriveFS(root, credentials,
+                                     validations=self.validations)
             except:
-                #Remove everything from user credentials
-                #Session nije ovo
-                flow = OAuth2WebServerFlow(CFG_GOOGLE_DRIVE_CLIENT_ID, 
-                                           CFG_GOOGLE_DRIVE_CLIENT_SECRET, 
-                                           CFG_GOOGLE_DRIVE_SCOPE,
-                                           callback_url)
-                url = flow.step1_get_authorize_url()
-                return url
+                return self._google_drive_authorize_url(callback_url)
           
         elif(request != None):
             try:
@@ -106,7 +174,8 @@ class CloudServiceFactory(object):
                 }
             }
             
-            filesystem = GoogleDriveFS(root, newData.get("google_drive"))
+            filesystem = GoogleDriveFS(root, newData.get("google_drive"),
+                                       validations=self.validations)
             return filesystem
     
     
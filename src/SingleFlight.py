@@ -0,0 +1,55 @@
+"""
+SingleFlight
+========
+
+Coalescing of concurrent identical requests, shared by the cloud
+filesystems.
+
+"""
+import sys
+import threading
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Makes concurrent calls with the same key share one execution.
+
+    The first thread calling do() with a key runs the function. Threads
+    calling do() with the same key while it runs wait for it and get
+    the same result (or the same exception). Once the call finished,
+    the next do() with that key runs the function again.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -2,7 +2,6 @@ from skydrive import api_v5
 import six
 import os
 import time
-from UserDict import UserDict
 
 # python filesystem imports
 from fs.base import FS
@@ -10,53 +9,37 @@ from fs.errors import PathError, UnsupportedError, \
                       CreateFailedError, ResourceInvalidError, \
                       ResourceNotFoundError, NoPathURLError, \
                       OperationFailedError
-from fs.remote import RemoteFileBuffer
 from fs.filelike import SpooledTemporaryFile
+from fs.path import abspath, normpath, pathsplit, pathjoin, iteratepath
+from CloudCache import CloudCache, CacheItem, PersistentCache, \
+                       token_fingerprint, CACHE_TTL, CACHE_MAX_ENTRIES, \
+                       CACHE_MAX_BYTES
+from RemoteFile import RemoteRangeFile, CloudFileBuffer, readonly_mode, \
+                       DOWNLOAD_BLOCK_SIZE
+from TokenValidation import UnauthorizedError, validations
+from WorkerPool import WorkerPool, WORKER_POOL_SIZE
+from SingleFlight import SingleFlight
 
-# Items in cache are considered expired after 5 minutes.
-CACHE_TTL = 300
 # Max size for spooling to memory before using disk (5M).
 MAX_BUFFER = 1024**2*5
 
-class CacheItem(object):
-    """Represents a path in the cache. There are two components to a path.
-       It's individual metadata, and the children contained within it."""
-    def __init__(self, metadata=None, children=None, timestamp=None):
-        self.metadata = metadata
-        self.children = children
-        if timestamp is None:
-            timestamp = time.time()
-        self.timestamp = timestamp
+class SkyDriveCache(CloudCache):
+    def __init__(self, **kwargs):
+        CloudCache.__init__(self, **kwargs)
+        #  SkyDrive names are case insensitive.
+        self.paths.normalize = lambda name: name.lower()
 
-    def add_child(self, name):
-        if self.children is None:
-            self.children = [name]
-        else:
-            self.children.append(name)
-
-    def del_child(self, name):
-        if self.children is None:
-            return
-        try:
-            i = self.children.index(name)
-        except ValueError:
-            return
-        self.children.pop(i)
-
-    def _get_expired(self):
-        if self.timestamp <= time.time() - CACHE_TTL:
-            return True
-    expired = property(_get_expired)
-
-    def renew(self):
-        self.timestamp = time.time()
-
-class SkyDriveCache(UserDict):
     def set(self, path, metadata):
         self[path] = CacheItem(metadata)
+        #  Index the name under the id of the parent, folders like
+        #  me/skydrive are resolved to their ids before they are looked in.
+        if metadata.get('parent_id') and 'name' in metadata:
+            self.paths.add(metadata['parent_id'], metadata['name'], 
+                           metadata['id'], metadata.get('created_time'))
 
     def pop(self, path, default=None):
-        value = UserDict.pop(self, path, default)
+        self.paths.discard(path)
+        value = CloudCache.pop(self, path, default)
         return value
 
 
@@ -64,30 +47,83 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
     def __init__(self, access_token):
         self.auth_access_token = access_token
         self.cache = SkyDriveCache()
+        # Fingerprint of the access token, set by SkyDriveFS.
+        self.account = None
+        # ValidationCache the outcomes of the requests are reported to.
+        self.validations = validations
+        self._flight = SingleFlight()
+    
+    def request(self, *args, **kwargs):
+        """Reports to validations whether the access token was accepted,
+            a 401 response raises UnauthorizedError."""
+        account = self.account
+        try:
+            result = super(SkyDriveClient, self).request(*args, **kwargs)
+        except (api_v5.AuthenticationError, api_v5.ProtocolError), e:
+            if (isinstance(e, api_v5.AuthenticationError) or 
+                    e.code == 401):
+                if account is not None:
+                    self.validations.failed(account)
+                raise UnauthorizedError(msg=str(e))
+            if account is not None:
+                self.validations.succeeded(account)
+            raise
+        if account is not None:
+            self.validations.succeeded(account)
+        return result
         
     def metadata(self, path):
-        "Gets metadata for a given path."
+        """Gets metadata for a given path.
+        
+        exists(), getinfo(), isdir() and friends all end up here, so 
+        concurrent lookups of the same path share one request, and a
+        path which was just found missing isn't asked for again.
+        """
         item = self.cache.get(path)
-        if not item or item.metadata is None or item.expired:
-            try:
-                metadata = super(SkyDriveClient, self).info(path)
-            except api_v5.ProtocolError, e:
-                if e.code == 404:
-                    raise ResourceNotFoundError(path)
-                
-                raise OperationFailedError(opname='metadata', path=path,
-                                            msg=str(e) )
-            
-            item = self.cache[path] = CacheItem(metadata)
+        if not item or item.metadata is None or self.cache.stale(item):
+            if path in self.cache.missing:
+                raise ResourceNotFoundError(path)
+            item = self._flight.do(('metadata', path), 
+                                   self._fetch_metadata, path)
         # Copy the info so the caller cannot affect our cache.
         return dict(item.metadata.items())
     
+    def _fetch_metadata(self, path):
+        #  Fetches metadata of path into the cache and returns the item.
+        item = self.cache.get(path)
+        if item and item.metadata is not None and not self.cache.stale(item):
+            # Another thread has just fetched it.
+            return item
+        try:
+            metadata = super(SkyDriveClient, self).info(path)
+        except api_v5.ProtocolError, e:
+            if e.code == 404:
+                self.cache.missing.add(path)
+                raise ResourceNotFoundError(path)
+            
+            raise OperationFailedError(opname='metadata', path=path,
+                                        msg=str(e) )
+        
+        item = self.cache[path] = CacheItem(metadata)
+        return item
+    
+    def cached_metadata(self, path):
+        "Gets metadata for a given path from the cache, None if not cached."
+        item = self.cache.get(path)
+        if not item or item.metadata is None or self.cache.stale(item):
+            return None
+        return dict(item.metadata.items())
+    
     def children(self, path):
-        "Gets children of a given path."
+        """Gets children of a given path.
+        
+        The full metadata of every child comes with the listing and is
+        cached, so getinfo() on the children needs no further requests.
+        """
         update = False
         item = self.cache.get(path)
         if item:
-            if item.expired:
+            if self.cache.stale(item):
                 update = True
             else:
                 if item.metadata["type"] != "folder" and not ("folder" in path):
@@ -97,26 +133,78 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
         else:
             update = True
         if update:
-            try:
+            if path in self.cache.missing:
+                raise ResourceNotFoundError(path)
+            item = self._flight.do(('children', path), self._fetch_children,
+                                   path)
+        return list(item.children)
+    
+    def _fetch_children(self, path):
+        #  Lists path into the cache and returns its item.
+        item = self.cache.get(path)
+        try:
+            if (item and item.metadata is not None and 
+                    not self.cache.stale(item)):
+                # The metadata of the folder is still good, only the
+                # listing is needed
+                metadata = item.metadata
+            else:
                 metadata = super(SkyDriveClient, self).info(path)
-                if metadata["type"] != "folder" and not ("folder" in path):
-                    raise ResourceInvalidError(path)
-                children = []
-                contents = super(SkyDriveClient, self).listdir(path)
-                for child in contents:
-                    children.append(child['id'])
-                    self.cache[child['id']] = CacheItem(child)
-                item = self.cache[path] = CacheItem(metadata, children)
-            except api_v5.ProtocolError, e:
-                if e.code == 404:
-                    raise ResourceNotFoundError(path)
-                if not item or e.resp.status != 304:
-                    raise OperationFailedError(opname='metadata',path=path, msg=str(e) )
-                # We have an item from cache (perhaps expired), but it's
-                # hash is still valid (as far as SkyDrive is concerned),
-                # so just renew it and keep using it.
-                item.renew()
-        return item.children
+            if metadata["type"] != "folder" and not ("folder" in path):
+                raise ResourceInvalidError(path)
+            children = []
+            names = []
+            contents = super(SkyDriveClient, self).listdir(path)
+            for child in contents:
+                children.append(child['id'])
+                names.append((child['name'], child['id'], 
+                              child.get('created_time')))
+                self.cache.set(child['id'], child)
+            item = self.cache[path] = CacheItem(metadata, children)
+            self.cache.paths.set_children(metadata['id'], names)
+        except api_v5.ProtocolError, e:
+            if e.code == 404:
+                self.cache.missing.add(path)
+                raise ResourceNotFoundError(path)
+            raise OperationFailedError(opname='metadata',path=path, msg=str(e) )
+        return item
+    
+    def resolve(self, root, path):
+        """Resolves a path of names, e.g. /Folder/Sub/file.txt, to an id.
+        
+        Every folder on the way is looked up in the path index, which is
+        filled by listings. A folder which isn't indexed yet is listed
+        once, so a warm path costs no requests at all.
+        
+        @param root: id of the folder the path starts in
+        @raise ResourceNotFoundError: if a part of the path doesn't exist
+        """
+        file_id = self.metadata(root)['id']
+        for name in iteratepath(path):
+            file_id = self._resolve_child(file_id, name, path)
+        return file_id
+    
+    def _resolve_child(self, parent_id, name, path):
+        ttl = CACHE_TTL if self.cache.expire else None
+        child_id = self.cache.paths.lookup(parent_id, name, ttl)
+        if child_id is None and not self.cache.paths.is_complete(parent_id, 
+                                                                 ttl):
+            self._index_children(parent_id)
+            child_id = self.cache.paths.lookup(parent_id, name, ttl)
+        if child_id is None:
+            raise ResourceNotFoundError(path)
+        return child_id
+    
+    def _index_children(self, folder_id):
+        #  Indexes all children of a folder. A listing which is still in
+        #  the cache (e.g. loaded from the persistent store) is reused.
+        names = []
+        for child_id in self.children(folder_id):
+            metadata = (self.cached_metadata(child_id) or 
+                        self.metadata(child_id))
+            names.append((metadata['name'], child_id, 
+                          metadata.get('created_time')))
+        self.cache.paths.set_children(folder_id, names)
     
     def file_create_folder(self, parent_id, title):
         "Add newly created directory to cache."
@@ -130,6 +218,7 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
             raise OperationFailedError(opname='file_create_folder', msg=str(e) )
             
         self.cache.set(metadata["id"], metadata)
+        self._listing_changed(parent_id, added=metadata["id"])
         return metadata
     
     def file_copy(self, src, dst):
@@ -140,9 +229,12 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
                 raise ResourceNotFoundError("Parent or source file don't exist")
             raise OperationFailedError(opname='file_copy', msg= str(e) )
             
-        self.cache.set(dst, metadata)
+        self.cache.missing.discard(metadata['id'])
+        self.cache.set(metadata['id'], metadata)
+        self._listing_changed(dst, added=metadata['id'])
         
     def file_move(self, src, dst):
+        old = self.cached_metadata(src)
         try:
             metadata = super(SkyDriveClient, self).copy(src, dst, True)
         except api_v5.ProtocolError, e:
@@ -150,10 +242,26 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
                 raise ResourceNotFoundError("Parent or source file don't exist")
             raise OperationFailedError(opname='file_copy', msg= str(e) )
             
-        self.cache.set(dst, metadata)
-            
         self.cache.pop(src, None)
-        self.cache.set(dst, metadata)
+        self.cache.missing.discard(metadata['id'])
+        self.cache.set(metadata['id'], metadata)
+        if old is not None:
+            self._listing_changed(old.get('parent_id'), removed=src)
+        self._listing_changed(dst, added=metadata['id'])
+        return metadata
+    
+    def _listing_changed(self, folder, added=None, removed=None):
+        #  Updates the cached children of a folder, if it was listed.
+        item = self.cache.get(folder)
+        if item is None or item.children is None:
+            return
+        added = [added] if added is not None else []
+        removed = [removed] if removed is not None else []
+        for child in removed:
+            item.del_child(child)
+        for child in added:
+            item.add_child(child)
+        self.cache.persist_children(folder, added, removed)
     
     def file_delete(self, path):
         try:
@@ -162,7 +270,11 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
             if e.code == 404:
                 raise ResourceNotFoundError(path)
             raise OperationFailedError(opname='file_copy', msg=str(e) )
+        old = self.cached_metadata(path)
         self.cache.pop(path, None)
+        self.cache.missing.add(path)
+        if old is not None:
+            self._listing_changed(old.get('parent_id'), removed=path)
     
     def put_file(self, parent_id, title, content, overwrite=False):
         try:
@@ -174,7 +286,20 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
         except TypeError, e:
             raise ResourceInvalidError("put_file")
         
+        #  The upload only returns the id, name and source of the file.
+        try:
+            metadata = super(SkyDriveClient, self).info(metadata['id'])
+        except api_v5.ProtocolError, e:
+            self.cache.pop(metadata['id'], None)
+            raise OperationFailedError(opname='put_file', msg=str(e) )
+        self.cache.paths.discard(metadata['id'])
         self.cache.set(metadata['id'], metadata)
+        self._listing_changed(parent_id, added=metadata['id'])
+        if metadata.get('parent_id') != parent_id:
+            #  parent_id was an alias like me/skydrive
+            self._listing_changed(metadata.get('parent_id'), 
+                                  added=metadata['id'])
+        return metadata
         
         
     def get_file(self, file_id):
@@ -196,14 +321,24 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
             
         return super(SkyDriveClient, self).get(file_id) 
     
+    def get_file_range(self, file_id, start, end):
+        "Gets the bytes between offsets start and end (inclusive) of a file."
+        try:
+            return super(SkyDriveClient, self).get(file_id, 
+                                        byte_range="%d-%d" % (start, end))
+        except api_v5.ProtocolError, e:
+            if e.code == 404:
+                raise ResourceNotFoundError("Source file doesn't exist")
+            raise OperationFailedError(opname='get_file_range', msg=str(e))
+    
     def update_file(self, file_id, new_file_info):
         try: 
             metadata = super(SkyDriveClient, self).info_update(file_id, new_file_info)
         except api_v5.ProtocolError, e:
-            if e.resp.status == 404:
+            if e.code == 404:
                 raise ResourceNotFoundError(path=file_id)
             
-            raise OperationFailedError(opname='file_copy', msg=e.resp.reason )
+            raise OperationFailedError(opname='file_copy', msg=str(e) )
          
         self.cache.pop(file_id, None)
         self.cache.set(metadata['id'], metadata)
@@ -213,6 +348,10 @@ class SkyDriveClient(api_v5.SkyDriveAPI):
 class SkyDriveFS(FS):
     """
         Sky drive file system
+        
+        Paths are object ids by default. With use_paths=True they are paths
+        of names instead, e.g. /Folder/Sub/file.txt, which are resolved to
+        ids with SkyDriveClient.resolve().
     """
     
     _meta = { 'thread_safe' : True,
@@ -229,7 +368,10 @@ class SkyDriveFS(FS):
               }
 
     def __init__(self, root=None, credentials=None, thread_synchronize=True, caching=False, 
-                 scope=["wl.skydrive_update"]):
+                 scope=["wl.skydrive_update"], cache_path=None, content_cache=None,
+                 listdir_workers=WORKER_POOL_SIZE, use_paths=False,
+                 cache_size=CACHE_MAX_ENTRIES, cache_bytes=CACHE_MAX_BYTES,
+                 sweep_interval=None, validations=None):
         self._root = root
         self._credentials = credentials
         self.cached_files = {}
@@ -249,6 +391,32 @@ class SkyDriveFS(FS):
                 self._credentials['access_token'] = os.environ.get('DROPBOX_ACCESS_TOKEN')
         
         self.client = SkyDriveClient(self._credentials["access_token"]) 
+        #  The account is keyed on the refresh token if there is one, so
+        #  the cached items outlive the short lived access tokens.
+        self._account = token_fingerprint(
+            self._credentials.get("refresh_token") or
+            self._credentials["access_token"])
+        self.client.account = self._account
+        #  Whether the token was accepted is reported to validations, by
+        #  default the ValidationCache shared by the whole process.
+        if validations is not None:
+            self.client.validations = validations
+        #  Metadata can be kept in an SQLite database at cache_path, so it
+        #  survives process restarts.
+        if cache_path is not None:
+            self.client.cache.store = PersistentCache(cache_path, self._account)
+        #  The metadata cache keeps at most cache_size items (and about
+        #  cache_bytes of metadata), expired items are removed every
+        #  sweep_interval seconds if it's set.
+        self.client.cache.configure(cache_size, cache_bytes, sweep_interval)
+        #  Bodies of downloaded files can be kept in a ContentCache.
+        self.content_cache = content_cache
+        #  Metadata that listdirinfo doesn't find in the cache is fetched by
+        #  at most listdir_workers threads.
+        self._workers = WorkerPool(listdir_workers)
+        self._use_paths = use_paths
+        #  Names are only indexed when they are used to resolve paths.
+        self.client.cache.paths.enabled = use_paths
         super(SkyDriveFS, self).__init__(thread_synchronize=thread_synchronize)
 
         
@@ -268,8 +436,6 @@ class SkyDriveFS(FS):
         @param path: Id of the file for which to update content
         @param data: content to write to the file  
         """
-        path = self._normpath(path)
-        
         if isinstance(data, basestring):
             string_data = data
         else:
@@ -279,8 +445,8 @@ class SkyDriveFS(FS):
             except:
                 raise ResourceInvalidError("Unsupported type")
             
-        f = self.getinfo(path)
-        return self.client.put( (f["name"], string_data), f["parent_id"], True )
+        f = self.client.metadata(path)
+        return self.client.put_file(f["parent_id"], f["name"], string_data, True)
 
     
     def setcontents(self, path, data="", chunk_size=64*1024, **kwargs):
@@ -322,6 +488,14 @@ class SkyDriveFS(FS):
         @raise PathError: If parent doesn't exist
         
         """
+        if self._use_paths:
+            parent_path, title = pathsplit(abspath(normpath(path)))
+            try:
+                parent_id = self._normpath(parent_path)
+            except ResourceNotFoundError:
+                raise PathError("parent doesn't exist")
+            return self.client.put_file(parent_id, title, "", True)
+        
         parts = path.split("/")
         if(parts[0] == ""):
             parent_id = self._root
@@ -336,19 +510,52 @@ class SkyDriveFS(FS):
             title = parts[0]
 
         
-        self.client.put((title, ""), parent_id, True)
+        self.client.put_file(parent_id, title, "", True)
         
     def open(self, path, mode='r',  buffering=-1, encoding=None, 
-             errors=None, newline=None, line_buffering=False, **kwargs):
+             errors=None, newline=None, line_buffering=False, lazy=True,
+             **kwargs):
         """Open the named file in the given mode.
 
         This method downloads the file contents into a local temporary file
         so that it can be worked on efficiently.  Any changes made to the
         file are only sent back to cloud storage when the file is flushed or closed.
-        """
-        path = self._normpath(path)
         
-        spooled_file = SpooledTemporaryFile(mode=mode, bufsize=MAX_BUFFER)
+        When the file is opened only for reading and lazy is True, nothing
+        is downloaded up front. The returned file fetches just the byte
+        ranges that are read.
+        
+        If the filesystem has a content cache, the file is read from the
+        cache as long as the cached updated_time is the current one.
+        """
+        if self._use_paths:
+            #  The buffer writes back through setcontents(path).
+            buffer_path = path
+            try:
+                path = self._normpath(path)
+            except ResourceNotFoundError:
+                if "w" not in mode and "a" not in mode:
+                    raise
+                path = self.createfile(buffer_path)["id"]
+        else:
+            buffer_path = path = self._normpath(path)
+        if self.content_cache is not None and "w" not in mode:
+            cached_file = self._open_cached(path)
+            if cached_file is not None:
+                if readonly_mode(mode):
+                    return cached_file
+                return CloudFileBuffer(self, buffer_path, mode, cached_file,
+                               hash_contents=kwargs.get('hash_contents', False))
+        if lazy and readonly_mode(mode):
+            metadata = self.client.metadata(path)
+            if metadata.get("type") == "folder":
+                raise ResourceInvalidError(path)
+            def fetch(start, end):
+                return self.client.get_file_range(path, start, end)
+            return RemoteRangeFile(fetch, metadata.get("size", 0), mode)
+        
+        
+        spooled_file = SpooledTemporaryFile(max_size=MAX_BUFFER, mode="w+b")
         
         #  Truncate the file if requested
         if "w" in mode:
@@ -361,12 +568,38 @@ class SkyDriveFS(FS):
                 if "w" not in mode and "a" not in mode:
                     raise ResourceNotFoundError("%r" % e)
                 else:
-                    self.createfile(path, True)
+                    self.createfile(buffer_path, True)
 
         
-        return RemoteFileBuffer(self,path,mode,spooled_file)
+        return CloudFileBuffer(self, buffer_path, mode, spooled_file,
+                               hash_contents=kwargs.get('hash_contents', False))
    
         
+    def _open_cached(self, path):
+        #  Returns the file from the content cache, downloading it into the
+        #  cache first if the cached revision is not the current one.
+        try:
+            metadata = self.client.metadata(path)
+        except ResourceNotFoundError:
+            return None
+        if metadata.get("type") == "folder":
+            raise ResourceInvalidError(path)
+        size = int(metadata.get("size", 0))
+        if size > self.content_cache.max_bytes:
+            #  Too big to be cached, it's read from SkyDrive instead.
+            return None
+        revision = metadata.get("updated_time")
+        cached_file = self.content_cache.open(self._account, path, revision)
+        if cached_file is None and revision:
+            #  The body is streamed into the cache with range requests, so
+            #  it's never held in memory as a whole.
+            def fetch(start, end):
+                return self.client.get_file_range(path, start, end)
+            body = RemoteRangeFile(fetch, size, blocksize=DOWNLOAD_BLOCK_SIZE)
+            cached_file = self.content_cache.store(self._account, path, 
+                                                   revision, body)
+        return cached_file
+        
     def is_root(self, path):
         path = self._normpath(path)
         if( path == self._root):
@@ -376,40 +609,45 @@ class SkyDriveFS(FS):
     def rename(self, src, dst):
         """
         @param src: id of the file to be renamed 
-        @param dst: new title of the file
+        @param dst: new title of the file, or its new path with use_paths.
+            A file renamed to a path in another folder is moved there.
         """
         if self.is_root(path = src):
             raise UnsupportedError("Can't rename the root directory")  
         
+        if self._use_paths:
+            file_id = self._normpath(src)
+            parent_path, name = pathsplit(abspath(normpath(dst)))
+            parent_id = self._normpath(parent_path)
+            if self.client.metadata(file_id).get("parent_id") != parent_id:
+                file_id = self.client.file_move(file_id, parent_id)["id"]
+            return self.client.update_file(file_id, {"name": name})
         
-        return self.client.update_file(src, {"name": dst})
+        return self.client.update_file(self._normpath(src), {"name": dst})
   
     def remove(self, path):
         """
         @param path: id of the folder to be deleted
         @return: None if removal was successful 
         """
-        path = self._normpath(path)
         if self.is_root(path = path):
             raise UnsupportedError("Can't remove the root directory")   
         if self.isdir(path = path):
             raise PathError("Specified path is a directory")  
 
-        return self.client.file_delete(path)
+        return self.client.file_delete(self._normpath(path))
     
     def removedir(self, path):
         """
         @param path: id of the folder to be deleted
         @return: None if removal was successful 
         """     
-        path = self._normpath(path)
-           
         if not self.isdir(path):
             raise PathError("Specified path is a directory") 
         if self.is_root(path = path):
             raise UnsupportedError("remove the root directory")
         
-        return self.client.file_delete(path)
+        return self.client.file_delete(self._normpath(path))
     
     def makedir(self, path, recursive=False, allow_recreate=False ):
         """
@@ -423,6 +661,8 @@ class SkyDriveFS(FS):
         @param allow_recreate: for google drive this param is always False, it will
             never recreate a directory with the same id ( same names are allowed )
         """
+        if self._use_paths:
+            return self._makedir_path(path, recursive, allow_recreate)
         parts = path.split("/")
         
         if( parts[0] == "" ):
@@ -447,6 +687,27 @@ class SkyDriveFS(FS):
             else:
                 title = parts[1]
             return self.client.file_create_folder(parent_id, title) 
+    
+    def _makedir_path(self, path, recursive, allow_recreate):
+        #  makedir() for paths of names, existing parents are reused when
+        #  creating recursively.
+        parent_path, title = pathsplit(abspath(normpath(path)))
+        try:
+            parent_id = self._normpath(parent_path)
+        except ResourceNotFoundError:
+            if not recursive:
+                raise PathError("parent '%s' doesn't exist" % parent_path)
+            parent_id = self._makedir_path(parent_path, True, True)["id"]
+        if allow_recreate:
+            try:
+                metadata = self.client.metadata(
+                                    self.client.resolve(parent_id, title))
+            except ResourceNotFoundError:
+                pass
+            else:
+                if metadata["type"] == "folder":
+                    return metadata
+        return self.client.file_create_folder(parent_id, title)
         
     def move(self, src, dst, overwrite=False, chunk_size=16384):
         """
@@ -462,7 +723,7 @@ class SkyDriveFS(FS):
             raise UnsupportedError("move a directory")
         
         
-        self.client.file_move(src, dst)
+        self.client.file_move(self._normpath(src), self._normpath(dst))
     
     def movedir(self, src, dst, overwrite=False, ignore_errors=False, chunk_size=16384):
         """
@@ -482,8 +743,8 @@ class SkyDriveFS(FS):
         
         path = self._normpath(path)
         
-        info = self.getinfo(path)
-        return "folder" in path or (info['type']=="folder")
+        info = self._getinfo(path)
+        return "folder" in path or info['isdir']
     
     def isfile(self, path):
         """
@@ -494,13 +755,17 @@ class SkyDriveFS(FS):
             it will return true or false even if the file/folder doesn't exist
         """
         path = self._normpath(path)
-        info = self.getinfo(path)
-        return "file" in path or (info['type']=="file")
+        info = self._getinfo(path)
+        #  Photos, videos and audio have their own types, everything which
+        #  isn't a folder is a file.
+        return not info['isdir']
     
     
     def exists(self, path):
         try:
-            return self.client.metadata(path)
+            return self.client.metadata(self._normpath(path))
+        except UnauthorizedError:
+            raise
         except:
             return False
 
@@ -513,12 +778,27 @@ class SkyDriveFS(FS):
                       files_only=False,
                       overrideCache=False
                       ):
-        path = self._normpath(path)
-        flist = self.client.children(path)
+        flist = self.client.children(self._normpath(path))
+        if self._use_paths:
+            names = [name for name in map(self._name, flist) 
+                     if name is not None]
+            return self._listdir_helper(path or "/", names, wildcard, full, 
+                                        absolute, dirs_only, files_only)
         dirContent = self._listdir_helper('', flist, wildcard, full, absolute, dirs_only, files_only)
         
         return dirContent
     
+    def _name(self, child_id):
+        #  Name of a child, the listing has just put it in the cache. None
+        #  if the child was deleted since the listing was cached.
+        metadata = self.client.cached_metadata(child_id)
+        if metadata is None:
+            try:
+                metadata = self.client.metadata(child_id)
+            except ResourceNotFoundError:
+                return None
+        return metadata["name"]
+    
     #Optimised listdir from pyfs
     def listdirinfo(self, path=None,
                           wildcard=None,
@@ -527,16 +807,33 @@ class SkyDriveFS(FS):
                           dirs_only=False,
                           files_only=False):
         
-        path = self._normpath(path)
+        paths = self.listdir(path,
+                             wildcard=wildcard,
+                             full=full,
+                             absolute=absolute,
+                             dirs_only=dirs_only,
+                             files_only=files_only)
         
-
-        return [(p, self.getinfo(p))
-                    for p in self.listdir(path,
-                                          wildcard=wildcard,
-                                          full=full,
-                                          absolute=absolute,
-                                          dirs_only=dirs_only,
-                                          files_only=files_only)]
+        #  Names are relative to the listed folder.
+        if self._use_paths and not (full or absolute):
+            targets = [pathjoin(path or "/", p) for p in paths]
+        else:
+            targets = paths
+        
+        #  The listing put the metadata of the children into the cache, only
+        #  the misses are fetched, in parallel.
+        infos = [None] * len(paths)
+        missing = []
+        for i, p in enumerate(paths):
+            metadata = self.client.cached_metadata(self._normpath(targets[i]))
+            if metadata is None:
+                missing.append(i)
+            else:
+                infos[i] = (p, self._metadata_to_info(metadata))
+        fetched = self._workers.map(self.getinfo, [targets[i] for i in missing])
+        for i, info in zip(missing, fetched):
+            infos[i] = (paths[i], info)
+        return infos
 
 
     def getinfo(self, path):
@@ -545,11 +842,20 @@ class SkyDriveFS(FS):
         @return: dictionary with informations about the specific file 
         @raise PathError: if the provided path doesn't exist 
         """
-        path = self._normpath(path)
-        if(not self.exists(path)):
+        try:
+            path = self._normpath(path)
+        except ResourceNotFoundError:
+            raise PathError("Specified path doesn't exist")
+        return self._getinfo(path)
+    
+    def _getinfo(self, file_id):
+        #  getinfo() of an id.
+        try:
+            metadata = self.client.metadata(file_id)
+        except ResourceNotFoundError:
             raise PathError("Specified path doesn't exist")
         
-        return self._metadata_to_info( self.client.metadata(path) )
+        return self._metadata_to_info(metadata)
         
     
     def getpathurl(self, path, allow_none=False):
@@ -567,19 +873,27 @@ class SkyDriveFS(FS):
         @rtype: unicode 
         
         """
-        path = self._normpath(path)
         url = None
         try:
-            url = self.getinfo(path)['source']
+            url = self._getinfo(self._normpath(path))['source']
         except:
             if not allow_none:
                 raise NoPathURLError(path=path)
 
         return url
     
+    def close(self):
+        self._workers.close()
+        self.client.cache.stop_sweeper()
+        super(SkyDriveFS, self).close()
+    
     def _normpath(self, path):
         #TODO: Well known folders are a problem
         
+        if self._use_paths:
+            if path is None or path == self._root or normpath(path) in ("", "/"):
+                return self._root
+            return self.client.resolve(self._root, path)
         if(path == self._root):
             return path
         elif(path == None):
@@ -607,9 +921,3 @@ class SkyDriveFS(FS):
         info.update(metadata)
         
         return info
-"""
-Problems:
-  - Flush and close, both call write contents and because of that 
-    the file on cloud is overwrite twice...
-"""
-
@@ -0,0 +1,35 @@
+"""
+StripedLock
+========
+
+Per-path locking shared by the cloud filesystems.
+
+"""
+import threading
+
+# Number of locks the paths are spread over.
+LOCK_STRIPES = 64
+
+
+class StripedLock(object):
+    """A fixed number of reentrant locks, each guarding a share of the keys.
+
+    lock(key) always returns the same lock for the same key, so two
+    threads working on the same path are serialized, while threads
+    working on different paths mostly get different locks and proceed
+    in parallel. Keys are never stored, so memory doesn't grow with
+    the number of paths.
+
+    @param stripes: number of locks
+    @param normalize: optional function applied to a key before hashing,
+        e.g. to make paths case insensitive
+
+    """
+    def __init__(self, stripes=LOCK_STRIPES, normalize=None):
+        self._locks = [threading.RLock() for i in xrange(stripes)]
+        self._normalize = normalize
+
+    def lock(self, key):
+        if self._normalize is not None:
+            key = self._normalize(key)
+        return self._locks[hash(key) % len(self._locks)]
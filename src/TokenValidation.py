@@ -0,0 +1,63 @@
+"""
+TokenValidation
+========
+
+Remembers which access tokens worked and which were rejected, so
+credentials are validated by the calls that are made anyway instead of
+by an extra request.
+
+"""
+import time
+import threading
+
+from fs.errors import RemoteConnectionError
+
+# Seconds for which the outcome of a validation is remembered (5 minutes).
+VALIDATION_WINDOW = 300
+
+
+class UnauthorizedError(RemoteConnectionError):
+    """The cloud service rejected the credentials (HTTP 401)."""
+    default_message = "Unauthorized: the credentials were rejected"
+
+
+class ValidationCache(object):
+    """Outcome of the last validation of each token, by token fingerprint.
+
+    Clients report every accepted request with succeeded() and every
+    401 with failed(). An outcome is forgotten window seconds after it
+    was reported, so a token is neither trusted nor rejected forever.
+
+    @param window: seconds an outcome is remembered
+
+    """
+    def __init__(self, window=VALIDATION_WINDOW):
+        self.window = window
+        self._outcomes = {}
+        self._lock = threading.Lock()
+
+    def succeeded(self, account):
+        self._outcomes[account] = (True, time.time())
+
+    def failed(self, account):
+        self._outcomes[account] = (False, time.time())
+
+    def forget(self, account):
+        self._outcomes.pop(account, None)
+
+    def valid(self, account):
+        """True if the token worked within the window, False if it was
+            rejected within the window, None if that isn't known."""
+        outcome = self._outcomes.get(account)
+        if outcome is None:
+            return None
+        if outcome[1] <= time.time() - self.window:
+            with self._lock:
+                if self._outcomes.get(account) == outcome:
+                    del self._outcomes[account]
+            return None
+        return outcome[0]
+
+
+# Shared by all clients and factories of the process.
+validations = ValidationCache()
@@ -0,0 +1,46 @@
+"""
+WorkerPool
+========
+
+A small bounded pool of threads for fetching many independent items at
+once, shared by the cloud filesystems.
+
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Max number of threads of a pool.
+WORKER_POOL_SIZE = 8
+
+
+class WorkerPool(object):
+    """Runs a function over many items with at most size threads.
+
+    The threads are started the first time there is more than one item
+    to work on, and they are reused by later calls.
+
+    @param size: max number of threads
+
+    """
+    def __init__(self, size=WORKER_POOL_SIZE):
+        self.size = size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def map(self, function, items):
+        """Returns [function(item) for item in items], in the order of
+        items. If a call raises, the exception is raised here."""
+        items = list(items)
+        if len(items) <= 1 or self.size <= 1:
+            return [function(item) for item in items]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.size)
+            pool = self._pool
+        return pool.map(function, items, chunksize=1)
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()